@@ -3,208 +3,452 @@
 OCR Image Generator - Organized Sample Version
 Generates 1-2 character samples organized by font, direction, and text color
 """
+import io
 import os
-import random
 import time
 import argparse
+import multiprocessing
+import cv2
 import numpy as np
-from PIL import Image
 
 # Import custom modules
-from color_utils import FontColor
-from font_utils import get_fonts, get_unsupported_chars
+from color_utils import FontColor, DOMINANT_COLOR_METHODS
+from font_utils import get_fonts, get_font_coverage, load_chars, FontPool, GlyphMetrics, GlyphAtlas, FontSampler
 from text_generator import get_char_lines
 from image_processor import get_horizontal_text_picture, get_vertical_text_picture
-from sample_organizer import save_organized_sample
+from shard_writer import ShardWriter
+from sample_writer import SampleWriter
+from background_store import BackgroundCache
+from checkpoint import resume_labels, save_checkpoint
+from distributed import node_labels_name, node_checkpoint_name, node_range
+from rng_utils import DEFAULT_RNG, sample_rng, new_run_seed
+from profiler import PROFILER, ProfileReport, tic, toc
 
 # Import existing modules
 from tools.config import load_config
-from noiser import Noiser
-from tools.utils import apply
-from data_aug import apply_blur_on_output, apply_prydown, apply_lr_motion, apply_up_motion
+from noiser import Noiser, NoiseBank
+from augment import AugmentPipeline
 
 
-def main():
-    """主函数 - 生成组织化的样本"""
+def build_parser():
+    """命令行参数"""
     parser = argparse.ArgumentParser()
-        
+
     parser.add_argument('--num_img', type=int, default=100, help="Number of images to generate")
-    
+
     parser.add_argument('--font_min_size', type=int, default=12)
     parser.add_argument('--font_max_size', type=int, default=70,
                         help="Can help adjust the size of the generated text and the size of the picture")
-    
+
     parser.add_argument('--bg_path', type=str, default='./background',
                         help='The generated text pictures will use the pictures of this folder as the background')
-                        
+
     parser.add_argument('--fonts_path', type=str, default='./fonts',
                         help='The font used to generate the picture')
-    
-    parser.add_argument('--corpus_path', type=str, default='./corpus', 
+
+    parser.add_argument('--corpus_path', type=str, default='./corpus',
                         help='The corpus used to generate the text picture')
-    
-    parser.add_argument('--color_path', type=str, default='./models/colors_new.cp', 
+
+    parser.add_argument('--color_path', type=str, default='./models/colors_new.cp',
                         help='Color font library used to generate text')
-    
+
     parser.add_argument('--chars_file', type=str, default='dict5990.txt',
                         help='Chars allowed to be appear in generated images')
 
     parser.add_argument('--customize_color', action='store_true', help='Support font custom color')
-    
+
+    parser.add_argument('--color_method', type=str, default='kmeans', choices=sorted(DOMINANT_COLOR_METHODS),
+                        help='Dominant color extractor used to pick the font color')
+
+    parser.add_argument('--font_sampling', type=str, default='random', choices=['random', 'text_first'],
+                        help='random: pick text and font independently; '
+                             'text_first: pick text first, then only fonts that support all of its chars')
+
     parser.add_argument('--blur', action='store_true', default=False,
-                        help="Apply gauss blur to the generated image")    
-    
+                        help="Apply gauss blur to the generated image")
+
     parser.add_argument('--prydown', action='store_true', default=False,
                     help="Blurred image, simulating the effect of enlargement of small pictures")
 
     parser.add_argument('--lr_motion', action='store_true', default=False,
                     help="Apply left and right motion blur")
-                    
+
     parser.add_argument('--ud_motion', action='store_true', default=False,
-                    help="Apply up and down motion blur")                    
-    
+                    help="Apply up and down motion blur")
+
     parser.add_argument('--random_offset', action='store_true', default=True,
-                help="Randomly add offset") 
-    
+                help="Randomly add offset")
+
     parser.add_argument('--config_file', type=str, default='noise.yaml',
                     help='Set the parameters when rendering images')
-      
+
     parser.add_argument('--output_dir', type=str, default='./organized_output/', help='Images save dir')
 
+    parser.add_argument('--output_format', type=str, default='dir', choices=['dir', 'shards'],
+                        help='dir: one JPEG per sample in font/direction/color folders; '
+                             'shards: pack samples into tar shards with a per-shard index')
+
+    parser.add_argument('--shard_size', type=int, default=10000,
+                        help='Samples per tar shard when --output_format is shards')
+
+    parser.add_argument('--write_threads', type=int, default=2,
+                        help='Threads that encode and save samples in the background of each process')
+
+    parser.add_argument('--write_queue', type=int, default=64,
+                        help='Max samples waiting to be saved, rendering blocks when the queue is full')
+
+    parser.add_argument('--profile', type=str, default=None,
+                        help='Write per-stage timings (count/total/p50/p95) and retry counts to this JSON file')
+
+    parser.add_argument('--profile_interval', type=float, default=60,
+                        help='Seconds between two updates of the --profile report during the run')
+
+    parser.add_argument('--bg_cache_mb', type=int, default=512,
+                        help='Memory budget (MB) for decoded backgrounds kept in each process, 0 disables the cache')
+
+    parser.add_argument('--font_pool_size', type=int, default=512,
+                        help='Max number of (font, size) objects kept loaded in each process')
+
+    parser.add_argument('--font_warmup', action='store_true', default=False,
+                        help='Load every font at every size in [font_min_size, font_max_size] before generating')
+
+    parser.add_argument('--glyph_cache_mb', type=int, default=64,
+                        help='Memory budget (MB) for rasterized text masks kept in each process, 0 disables the cache')
+
+    parser.add_argument('--glyph_prefill', type=int, nargs='*', default=[],
+                        help='Font sizes at which every single char of chars_file is rasterized for every font before '
+                             'generating; covers vertical and spaced horizontal text and 1-char texts, 2-char texts '
+                             'drawn without spacing are cached on first use')
+
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes used to render samples, 1 means render in the main process')
+
+    parser.add_argument('--chunk_size', type=int, default=0,
+                        help='Samples per task handed to a worker process, 0 means choose automatically')
+
+    parser.add_argument('--num_shards', type=int, default=1,
+                        help='Number of nodes generating into the same output_dir, each node makes --num_img samples')
+
+    parser.add_argument('--shard_id', type=int, default=0,
+                        help='Index of this node in [0, num_shards), selects its sample index range')
+
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Run seed, sample i is rendered from a generator seeded with (seed, i); '
+                             'default: the seed saved in the checkpoint, else a random one')
+
+    return parser
+
+
+class GeneratorContext(object):
+    """生成样本所需的资源，每个进程只加载一次"""
+
+    def __init__(self, cf, noise_bank=None):
+        self.cf = cf
+
+        print('cf.config_file', cf.config_file)
+        self.flag = load_config(cf.config_file)
+
+        # 实例化噪音参数，noise_bank 为主进程在共享内存中预先生成的噪声场
+        self.noiser = Noiser(self.flag, bank=noise_bank)
+
+        # 图像增强，按配置文件的 augment 部分和命令行参数启用
+        self.augment = AugmentPipeline(self.flag, self.noiser, cf)
+
+        # 读入字体色彩库
+        self.color_lib = FontColor(cf.color_path)
+        print('color_lib loaded successfully')
+
+        # 读入字体
+        self.fonts_list = get_fonts(cf.fonts_path)
+        print(f'Loaded {len(self.fonts_list)} fonts')
+        self.font_pool = FontPool(cf.font_pool_size)
+        if cf.font_warmup:
+            self.font_pool.warmup(self.fonts_list, cf.font_min_size, cf.font_max_size)
+            print(f'Warmed up {len(self.font_pool)} fonts')
+        # 字形度量表，保存在磁盘缓存中，之后的运行和其他进程可以直接使用
+        self.glyph_metrics = GlyphMetrics()
+
+        # 读入语料库
+        self.char_lines = get_char_lines(txt_root_path=cf.corpus_path)
+        print(f'Loaded {len(self.char_lines)} text lines')
+
+        # 读入背景图片
+        self.img_root_path = cf.bg_path
+        # 排序后背景的编号与文件系统无关，同样的种子在不同机器上选中同样的背景
+        self.imnames = sorted(os.listdir(self.img_root_path))
+        print(f'Loaded {len(self.imnames)} background images')
+        self.bg_cache = None
+        if cf.bg_cache_mb > 0:
+            self.bg_cache = BackgroundCache(cf.bg_cache_mb * 1024 * 1024)
+
+        # 字典文件
+        self.font_coverage = get_font_coverage(self.fonts_list, cf.chars_file)
+
+        # 文字蒙版缓存，绘制时直接混合缓存的蒙版，不再每次调用 FreeType 光栅化
+        self.glyph_atlas = None
+        if cf.glyph_cache_mb > 0:
+            self.glyph_atlas = GlyphAtlas(cf.glyph_cache_mb * 1024 * 1024)
+            if cf.glyph_prefill:
+                self.glyph_atlas.prefill(self.font_pool, self.fonts_list, load_chars(cf.chars_file),
+                                         cf.glyph_prefill, self.font_coverage)
+                print(f'Prefilled {len(self.glyph_atlas)} glyph masks ({self.glyph_atlas.nbytes / 1024 / 1024:.1f} MB)')
+
+        # 字体采样，权重在配置文件的 font.weights 中设置
+        font_cfg = self.flag.get('font') or {}
+        self.font_sampler = FontSampler(self.fonts_list, self.font_coverage, font_cfg.get('weights'),
+                                        text_first=cf.font_sampling == 'text_first')
+
+
+def new_stats():
+    """统计信息"""
+    return {
+        'total': 0,
+        'horizontal': 0,
+        'vertical': 0,
+        'black_on_white': 0,
+        'white_on_black': 0,
+        'fonts': set(),
+        'font_pool_hits': 0,
+        'font_pool_misses': 0
+    }
+
+
+def copy_stats(stats):
+    """复制统计信息"""
+    return dict(stats, fonts=set(stats['fonts']))
+
+
+def merge_stats(stats, other):
+    """合并其他进程返回的统计信息"""
+    for key, value in other.items():
+        if key == 'fonts':
+            stats['fonts'] |= value
+        else:
+            stats[key] += value
+    return stats
+
+
+def count_sample(stats, sample_info):
+    """样本保存后更新统计信息"""
+    stats['total'] += 1
+    stats['horizontal' if sample_info['direction'] == 'horizontal' else 'vertical'] += 1
+    stats['fonts'].add(sample_info['font_name'])
+    if sample_info['color_type'] == 'black_on_white':
+        stats['black_on_white'] += 1
+    else:
+        stats['white_on_black'] += 1
+
+
+def open_writer(cf, labels, stats, on_flush=None):
+    """创建后台写入器，样本写入磁盘后写标签并更新统计信息"""
+    def on_commit(i, chars, sample_info):
+        count_sample(stats, sample_info)
+        print(f'Generated: {i:04d} - {chars} - {sample_info["font_name"]} - {sample_info["direction"]} - {sample_info["color_type"]}')
+
+    shard_writer = ShardWriter(cf.output_dir, cf.shard_size) if cf.output_format == 'shards' else None
+    return SampleWriter(cf.output_dir, labels, threads=cf.write_threads, max_pending=cf.write_queue,
+                        shard_writer=shard_writer, on_commit=on_commit, on_flush=on_flush)
+
+
+def render_sample(ctx, index, rng=None):
+    """
+    渲染编号为 index 的样本并做增强。所有随机选择都来自由 (运行种子, index) 派生的生成器，
+    同样的种子、配置和资源下，任意一个样本都可以单独重新生成，与生成顺序无关
+    :param rng: 随机数生成器，默认为 sample_rng(ctx.cf.seed, index)，cf.seed 为 None 时使用进程的默认生成器
+    :return: (uint8 RGB 数组, 文字, 字体路径, 是否垂直, render_info)
+    """
+    cf = ctx.cf
+    if rng is None:
+        rng = sample_rng(cf.seed, index) if cf.seed is not None else DEFAULT_RNG
+
+    # 随机选择背景图片
+    imname = rng.choice(ctx.imnames)
+    img_path = os.path.join(ctx.img_root_path, imname)
+
+    # 随机决定水平或垂直文本
+    rnd = rng.random()
+    is_vertical = rnd >= 0.8  # 20%概率生成垂直文本
+
+    if not is_vertical:  # 水平文本
+        gen_img, chars, font_path, render_info = get_horizontal_text_picture(
+            img_path, ctx.color_lib, ctx.char_lines, ctx.fonts_list, ctx.font_coverage, cf,
+            bg_cache=ctx.bg_cache, font_pool=ctx.font_pool, glyph_metrics=ctx.glyph_metrics,
+            font_sampler=ctx.font_sampler, rng=rng, glyph_atlas=ctx.glyph_atlas
+        )
+    else:  # 垂直文本
+        gen_img, chars, font_path, render_info = get_vertical_text_picture(
+            img_path, ctx.color_lib, ctx.char_lines, ctx.fonts_list, ctx.font_coverage, cf,
+            bg_cache=ctx.bg_cache, font_pool=ctx.font_pool, glyph_metrics=ctx.glyph_metrics,
+            font_sampler=ctx.font_sampler, rng=rng, glyph_atlas=ctx.glyph_atlas
+        )
+
+    # 渲染函数返回新的 uint8 RGB 数组，增强直接在上面原地进行，之后编码和保存都直接使用数组
+    gen_img = ctx.augment(gen_img, rng)
+    return gen_img, chars, font_path, is_vertical, render_info
+
+
+def generate_samples(start, end, ctx, stats, writer):
+    """
+    生成编号 [start, end) 的样本，交给 writer 在后台编码保存
+    :param writer: SampleWriter
+    """
+    for i in range(start, end):
+        try:
+            t_sample = tic()
+            font_hits, font_misses = ctx.font_pool.hits, ctx.font_pool.misses
+
+            gen_img, chars, font_path, is_vertical, render_info = render_sample(ctx, i)
+
+            stats['font_pool_hits'] += ctx.font_pool.hits - font_hits
+            stats['font_pool_misses'] += ctx.font_pool.misses - font_misses
+
+            # 保存组织化的样本，编码和写盘在后台线程中完成，分类直接使用渲染时的文字和背景颜色
+            writer.submit(gen_img, chars, font_path, is_vertical, i, render_info=render_info)
+            toc('sample', t_sample)
+
+        except Exception as e:
+            print(f'Error generating sample {i}: {e}')
+            continue
+
+
+# 子进程中的生成资源，由 _init_worker 加载
+_worker_ctx = None
+
+
+def _init_worker(cf, noise_bank_spec=None):
+    """子进程初始化：加载一次字体、色彩库和背景，映射共享的噪声场，并重新播种默认的随机数生成器"""
+    global _worker_ctx
+    # 样本的随机数由 (运行种子, 编号) 决定；fork 出来的子进程还会继承默认生成器的状态，重新播种
+    DEFAULT_RNG.seed()
+    # 多进程并行时，避免每个进程再开满 OpenCV 线程
+    cv2.setNumThreads(1)
+    PROFILER.enabled = bool(cf.profile)
+    noise_bank = NoiseBank.attach(noise_bank_spec) if noise_bank_spec is not None else None
+    _worker_ctx = GeneratorContext(cf, noise_bank)
+
+
+def _generate_chunk(task):
+    """子进程任务：生成一段连续编号的样本，图片全部写入磁盘后返回标签、统计信息和各阶段耗时"""
+    start, end = task
+    stats = new_stats()
+    labels = io.StringIO()
+    # 分片模式下每个任务正好是一个分片
+    try:
+        with open_writer(_worker_ctx.cf, labels, stats) as writer:
+            generate_samples(start, end, _worker_ctx, stats, writer)
+    finally:
+        # 任务出错或被中断时也保存已测得的字形度量
+        _worker_ctx.glyph_metrics.save()
+    return labels.getvalue(), stats, PROFILER.snapshot(reset=True)
+
+
+def create_noise_bank(cf):
+    """按配置文件的 noise_bank 部分生成共享的噪声场，未启用噪声或噪声场时返回 None"""
+    flag = load_config(cf.config_file)
+    bank_cfg = flag.get('noise_bank') or {}
+    if not flag.noise.enable or not bank_cfg.get('enable', False):
+        return None
+    # 噪声场由运行种子生成，重新生成单个样本时噪声也相同
+    bank = NoiseBank.create(bank_cfg.get('fields', 4), bank_cfg.get('size', 512), seed=cf.seed)
+    print(f'Noise bank: {bank.shape[0]} fields of {bank.shape[1]}x{bank.shape[2]} in shared memory')
+    return bank
+
+
+def split_range(start, end, chunk_size):
+    """将编号区间 [start, end) 切分成若干段"""
+    return [(s, min(s + chunk_size, end)) for s in range(start, end, chunk_size)]
+
+
+def main():
+    """主函数 - 生成组织化的样本"""
+    parser = build_parser()
     cf = parser.parse_args()
-    
-    print('cf.config_file', cf.config_file)
-    flag = load_config(cf.config_file) 
-    
-    # 实例化噪音参数
-    noiser = Noiser(flag) 
-    
-    # 读入字体色彩库
-    color_lib = FontColor(cf.color_path)
-    print('color_lib loaded successfully')
-    
-    # 读入字体
-    fonts_path = cf.fonts_path
-    fonts_list = get_fonts(fonts_path)
-    print(f'Loaded {len(fonts_list)} fonts')
-
-    # 读入语料库
-    txt_root_path = cf.corpus_path
-    char_lines = get_char_lines(txt_root_path=txt_root_path)     
-    print(f'Loaded {len(char_lines)} text lines')
-
-    # 读入背景图片
-    img_root_path = cf.bg_path
-    imnames = os.listdir(img_root_path)
-    print(f'Loaded {len(imnames)} background images')
-    
+    if not 0 <= cf.shard_id < cf.num_shards:
+        parser.error('--shard_id must be in [0, --num_shards)')
+
     # 创建输出目录
     os.makedirs(cf.output_dir, exist_ok=True)
-    
-    # 处理标签文件
-    labels_path = os.path.join(cf.output_dir, 'labels.txt')
-    gs = 0
-    if os.path.exists(labels_path):  # 支持中断程序后，在生成的图片基础上继续
-        with open(labels_path, 'r', encoding='utf-8') as f:
-            lines = list(f.readlines())
-        if lines:
-            gs = int(lines[-1].strip().split('\t')[0])
-            print('Resume generating from step %d' % gs)
-        
-    # 字典文件    
-    chars_file = cf.chars_file
-    font_unsupport_chars = get_unsupported_chars(fonts_list, chars_file)
-    
+
+    # 处理标签文件，多节点时每个节点写自己的标签文件和断点文件，之后用 distributed.py 合并
+    labels_path = os.path.join(cf.output_dir, node_labels_name(cf.shard_id, cf.num_shards))
+    checkpoint_name = node_checkpoint_name(cf.shard_id, cf.num_shards)
+    # 支持中断程序后，在生成的图片基础上继续：读取断点文件，没有时读取标签文件的最后一行
+    gs, checkpoint = resume_labels(cf.output_dir, labels_path, checkpoint_name)
+    if gs:
+        print('Resume generating from step %d' % gs)
+    # 运行种子：命令行指定的优先，续跑时沿用断点文件中的种子
+    if cf.seed is None:
+        cf.seed = checkpoint['seed'] if checkpoint is not None else new_run_seed()
+    print(f'Seed: {cf.seed}')
+    # 多节点时各节点的编号区间互不重叠，图片文件名和分片名也就不会冲突
+    first, end = node_range(cf.shard_id, cf.num_shards, cf.num_img, gs)
+    if cf.num_shards > 1:
+        print(f'Shard {cf.shard_id}/{cf.num_shards}: samples [{first}, {end})')
+    total_stats = checkpoint['stats'] if checkpoint is not None else new_stats()
+
     # 开始生成图片
     print('Start generating organized samples...')
     t0 = time.time()
-    
+
     # 统计信息
-    stats = {
-        'total': 0,
-        'horizontal': 0,
-        'vertical': 0,
-        'black_on_white': 0,
-        'white_on_black': 0,
-        'fonts': set()
-    }
-    
-    with open(labels_path, 'a', encoding='utf-8') as f:
-        for i in range(gs + 1, gs + cf.num_img + 1):
-            try:
-                # 随机选择背景图片
-                imname = random.choice(imnames)
-                img_path = os.path.join(img_root_path, imname)
-
-                # 随机决定水平或垂直文本
-                rnd = random.random()
-                is_vertical = rnd >= 0.8  # 20%概率生成垂直文本
-                
-                if not is_vertical:  # 水平文本
-                    gen_img, chars, font_path = get_horizontal_text_picture(
-                        img_path, color_lib, char_lines, fonts_list, font_unsupport_chars, cf
-                    )
-                    stats['horizontal'] += 1
-                else:  # 垂直文本
-                    gen_img, chars, font_path = get_vertical_text_picture(
-                        img_path, color_lib, char_lines, fonts_list, font_unsupport_chars, cf
-                    )
-                    stats['vertical'] += 1
-                
-                if gen_img.mode != 'RGB':
-                    gen_img = gen_img.convert('RGB')           
-                
-                # 应用各种图像增强效果
-                if cf.blur:
-                    image_arr = np.array(gen_img) 
-                    gen_img = apply_blur_on_output(image_arr)            
-                    gen_img = Image.fromarray(np.uint8(gen_img))
-                    
-                if cf.prydown:
-                    image_arr = np.array(gen_img) 
-                    gen_img = apply_prydown(image_arr)
-                    gen_img = Image.fromarray(np.uint8(gen_img))
-                    
-                if cf.lr_motion:
-                    image_arr = np.array(gen_img)
-                    gen_img = apply_lr_motion(image_arr)
-                    gen_img = Image.fromarray(np.uint8(gen_img))       
-                    
-                if cf.ud_motion:
-                    image_arr = np.array(gen_img)
-                    gen_img = apply_up_motion(image_arr)        
-                    gen_img = Image.fromarray(np.uint8(gen_img)) 
-
-                if apply(flag.noise):
-                    gen_img = np.clip(gen_img, 0., 255.)
-                    gen_img = noiser.apply(gen_img)
-                    gen_img = Image.fromarray(np.uint8(gen_img))
-                
-                # 保存组织化的样本
-                filepath, sample_info = save_organized_sample(
-                    gen_img, chars, cf.output_dir, font_path, is_vertical, i
-                )
-                
-                # 更新统计信息
-                stats['total'] += 1
-                stats['fonts'].add(sample_info['font_name'])
-                if sample_info['color_type'] == 'black_on_white':
-                    stats['black_on_white'] += 1
-                else:
-                    stats['white_on_black'] += 1
-                
-                # 写入标签文件
-                relative_path = os.path.relpath(filepath, cf.output_dir)
-                f.write(f"{i}\t{relative_path}\t{chars}\t{sample_info['font_name']}\t{sample_info['direction']}\t{sample_info['color_type']}\n")
-                
-                print(f'Generated: {i:04d} - {chars} - {sample_info["font_name"]} - {sample_info["direction"]} - {sample_info["color_type"]}')
-                
-            except Exception as e:
-                print(f'Error generating sample {i}: {e}')
-                continue
-        
+    stats = new_stats()
+
+    # 各阶段耗时，只在指定 --profile 时统计
+    report = None
+    if cf.profile:
+        PROFILER.enabled = True
+        report = ProfileReport(cf.profile, cf.profile_interval)
+
+    # 噪声场只生成一份，子进程通过共享内存读取
+    noise_bank = create_noise_bank(cf)
+
+    try:
+        with open(labels_path, 'a', encoding='utf-8') as f:
+            if cf.workers <= 1:
+                ctx = GeneratorContext(cf, noise_bank)
+
+                def on_flush(last_index):
+                    save_checkpoint(cf.output_dir, last_index, os.fstat(f.fileno()).st_size,
+                                    merge_stats(copy_stats(total_stats), stats), cf.seed,
+                                    checkpoint_name)
+                    if report is not None:
+                        report.update(samples=stats['total'])
+
+                # 中断时 with 会等待已提交的样本写完，标签文件中的每一行都有对应的图片
+                try:
+                    with open_writer(cf, f, stats, on_flush) as writer:
+                        generate_samples(first, end, ctx, stats, writer)
+                finally:
+                    # 中断后续跑时不必重新测量已经渲染过的字形
+                    ctx.glyph_metrics.save()
+            else:
+                chunk_size = cf.chunk_size
+                if cf.output_format == 'shards':
+                    # 每个分片由一个进程写完，分片之间互不干扰
+                    chunk_size = cf.shard_size
+                elif chunk_size <= 0:
+                    # 每个进程分到约 4 段，兼顾负载均衡与标签写入的及时性
+                    chunk_size = max(1, min(1000, -(-(end - first) // (cf.workers * 4))))
+                tasks = split_range(first, end, chunk_size)
+                print(f'Rendering {len(tasks)} chunks with {cf.workers} workers')
+                with multiprocessing.Pool(cf.workers, initializer=_init_worker,
+                                          initargs=(cf, noise_bank and noise_bank.spec)) as pool:
+                    # imap 按任务顺序返回结果，标签文件因此保持编号顺序
+                    for (start, stop), (labels, chunk_stats, profile) in zip(tasks, pool.imap(_generate_chunk, tasks)):
+                        f.write(labels)
+                        f.flush()
+                        merge_stats(stats, chunk_stats)
+                        if report is not None:
+                            PROFILER.merge(profile)
+                            report.update(samples=stats['total'])
+                        save_checkpoint(cf.output_dir, stop - 1, os.fstat(f.fileno()).st_size,
+                                        merge_stats(copy_stats(total_stats), stats), cf.seed, checkpoint_name)
+    finally:
+        if noise_bank is not None:
+            noise_bank.close()
+
     t1 = time.time()
-    
+
     # 打印统计信息
     print('\n=== Generation Complete ===')
     print(f'Total time: {t1 - t0:.2f} seconds')
@@ -215,6 +459,10 @@ def main():
     print(f'White on black: {stats["white_on_black"]}')
     print(f'Fonts used: {len(stats["fonts"])}')
     print(f'Font names: {", ".join(sorted(stats["fonts"]))}')
+    print(f'Font pool: {stats["font_pool_hits"]} hits, {stats["font_pool_misses"]} misses')
+    if report is not None:
+        report.write(samples=stats['total'])
+        print(f'Profile report written to {cf.profile}')
 
 
 if __name__ == '__main__':
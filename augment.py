@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Augmentation utilities for OCR image generation
+Contains the augmentation pipeline applied to rendered samples, configured by the augment section of the YAML config
+"""
+import numpy as np
+from easydict import EasyDict
+
+from data_aug import apply_blur_on_output, apply_prydown, apply_lr_motion, apply_up_motion
+from tools.utils import apply
+from profiler import tic, toc
+from rng_utils import get_rng
+
+# 增强的执行顺序，与命令行参数同名
+AUGMENT_OPS = ['blur', 'prydown', 'lr_motion', 'ud_motion']
+
+
+class AugmentPipeline(object):
+    """
+    对 uint8 RGB 数组依次做模糊、缩放模糊、运动模糊和噪声。
+    所有操作直接写回输入数组，中间结果使用复用的缓冲区，整个过程不转换成 PIL 图片。
+    配置文件中的 augment.<op> 含 enable 和 fraction（执行概率），命令行的 --blur 等参数会强制启用对应操作。
+    """
+
+    def __init__(self, flag, noiser, cf=None):
+        """
+        :param flag: load_config 读入的配置
+        :param noiser: Noiser，配置中 noise.enable 为 true 时按 noise.fraction 的概率加噪声
+        :param cf: 命令行参数
+        """
+        aug_cfg = flag.get('augment') or {}
+        self.ops = []
+        for name in AUGMENT_OPS:
+            op_cfg = EasyDict(aug_cfg.get(name) or {'enable': False, 'fraction': 1.0})
+            if cf is not None and getattr(cf, name, False):
+                op_cfg = EasyDict(enable=True, fraction=1.0)
+            if op_cfg.enable:
+                self.ops.append((name, op_cfg))
+        self.noise_cfg = flag.noise
+        self.noiser = noiser
+        self._scratch = np.empty(0, dtype=np.uint8)
+
+    def _get_scratch(self, size):
+        """复用的一维缓冲区，不够大时扩容"""
+        if self._scratch.size < size:
+            self._scratch = np.empty(size, dtype=np.uint8)
+        return self._scratch
+
+    def __call__(self, img, rng=None):
+        """
+        :param img: uint8 RGB 数组，归调用方所有，会被原地修改
+        :param rng: 样本的随机数生成器，见 rng_utils.SampleRandom
+        :return: 增强后的 uint8 数组（多数情况下就是 img）
+        """
+        rng = get_rng(rng)
+        t = tic()
+        for name, op_cfg in self.ops:
+            if op_cfg.fraction < 1 and not apply(op_cfg, rng):
+                continue
+            if name == 'blur':
+                apply_blur_on_output(img, dst=img, rng=rng)
+            elif name == 'prydown':
+                apply_prydown(img, dst=img, scratch=self._get_scratch(img.size), rng=rng)
+            elif name == 'lr_motion':
+                apply_lr_motion(img, dst=img)
+            elif name == 'ud_motion':
+                apply_up_motion(img, dst=img)
+            t = toc('aug_' + name, t)
+
+        if apply(self.noise_cfg, rng):
+            img = self.noiser.apply(img, dst=img, rng=rng)
+            toc('noise', t)
+        return img
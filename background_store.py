@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Background store for OCR image generation
+Contains an LRU cache of decoded RGB backgrounds bounded by a memory budget
+"""
+import os
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from cache_utils import get_cache_dir, file_key, atomic_write
+
+# 积分图缓存文件的版本，格式或数值类型变化时加一，旧文件不再使用
+INTEGRAL_VERSION = 2
+
+
+def load_background(image_file):
+    """读取背景图片，返回 RGB 数组"""
+    img = Image.open(image_file)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    return np.asarray(img)
+
+
+def lab_integrals(lab):
+    """
+    Lab 图像的积分图和平方积分图，形状均为 (h + 1, w + 1, 3)
+    积分图最大为 h * w * 255，不超过 int32 时（约 8M 像素以内）用 int32，否则用 float64 以免溢出；
+    平方积分图用 float64
+    """
+    h, w = lab.shape[:2]
+    sdepth = cv2.CV_32S if h * w * 255 <= np.iinfo(np.int32).max else cv2.CV_64F
+    return cv2.integral2(lab, sdepth=sdepth, sqdepth=cv2.CV_64F)
+
+
+class Background(object):
+    """
+    解码后的背景图片，附带 Lab 图像及其积分图。
+    任意矩形区域的 Lab 标准差可以在常数时间内算出，不需要裁剪图片。
+    """
+
+    def __init__(self, rgb, lab=None, lab_sum=None, lab_sqsum=None):
+        self.rgb = rgb
+        self.lab = lab if lab is not None else cv2.cvtColor(rgb, cv2.COLOR_RGB2Lab)
+        if lab_sum is None or lab_sqsum is None:
+            lab_sum, lab_sqsum = lab_integrals(self.lab)
+        self.lab_sum = lab_sum
+        self.lab_sqsum = lab_sqsum
+        for arr in (self.rgb, self.lab, self.lab_sum, self.lab_sqsum):
+            if arr.flags.writeable:
+                arr.flags.writeable = False
+
+    @property
+    def size(self):
+        """(w, h)，与 PIL 的 Image.size 一致"""
+        return self.rgb.shape[1], self.rgb.shape[0]
+
+    @property
+    def nbytes(self):
+        """占用的内存，从磁盘映射的积分图不计入"""
+        n = self.rgb.nbytes + self.lab.nbytes
+        for arr in (self.lab_sum, self.lab_sqsum):
+            if not isinstance(arr, np.memmap):
+                n += arr.nbytes
+        return n
+
+    def lab_std(self, x1, y1, x2, y2):
+        """矩形 [x1, x2) x [y1, y2) 内 Lab 三个通道标准差组成的向量的模"""
+        n = (x2 - x1) * (y2 - y1)
+        if n <= 0:
+            return 0.
+        ys, xs = [y1, y1, y2, y2], [x1, x2, x1, x2]
+        c = self.lab_sum[ys, xs].astype(np.float64)
+        c2 = self.lab_sqsum[ys, xs]
+        s = c[3] - c[2] - c[1] + c[0]
+        sq = c2[3] - c2[2] - c2[1] + c2[0]
+        mean = s / n
+        var = np.maximum(sq / n - mean * mean, 0)
+        return float(np.sqrt(var.sum()))
+
+
+class BackgroundCache(object):
+    """
+    按字节预算缓存解码后的背景图片，超出预算时淘汰最久未使用的图片。
+    缓存中的数组是只读的，渲染时只复制裁剪区域并在副本上绘制，缓存的原图不会被修改。
+    积分图在第一次加载时计算并保存到磁盘缓存目录，之后直接映射读取。
+    """
+
+    def __init__(self, max_bytes, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _load(self, image_file):
+        """解码背景图片，积分图优先从磁盘缓存读取"""
+        rgb = load_background(image_file)
+        lab = cv2.cvtColor(rgb, cv2.COLOR_RGB2Lab)
+        cache_dir = self.cache_dir or get_cache_dir()
+        prefix = os.path.join(cache_dir, 'bg%d_%s' % (INTEGRAL_VERSION, file_key(image_file)))
+        sum_file, sqsum_file = prefix + '_sum.npy', prefix + '_sqsum.npy'
+        try:
+            lab_sum = np.load(sum_file, mmap_mode='r')
+            lab_sqsum = np.load(sqsum_file, mmap_mode='r')
+            if lab_sum.shape[:2] != (rgb.shape[0] + 1, rgb.shape[1] + 1):
+                raise ValueError('integral image shape mismatch')
+        except (OSError, ValueError):
+            lab_sum, lab_sqsum = lab_integrals(lab)
+            try:
+                # 先写临时文件再改名，避免其他进程读到写了一半的文件
+                for path, arr in ((sum_file, lab_sum), (sqsum_file, lab_sqsum)):
+                    with atomic_write(path) as f:
+                        np.save(f, arr)
+            except OSError as e:
+                print(f'Could not save integral images of {image_file}: {e}')
+        return Background(rgb, lab, lab_sum, lab_sqsum)
+
+    def get(self, image_file):
+        """返回背景图片的 Background 对象"""
+        bg = self._entries.get(image_file)
+        if bg is not None:
+            self._entries.move_to_end(image_file)
+            self.hits += 1
+            return bg
+
+        self.misses += 1
+        bg = self._load(image_file)
+
+        # 单张图片就超过预算时不缓存
+        if bg.nbytes <= self.max_bytes:
+            self._entries[image_file] = bg
+            self.nbytes += bg.nbytes
+            while self.nbytes > self.max_bytes:
+                _, old = self._entries.popitem(last=False)
+                self.nbytes -= old.nbytes
+        return bg
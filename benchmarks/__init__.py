@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for OCR image generation
+Run from the repository root: python -m benchmarks.run
+"""
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark runner for OCR image generation
+Contains micro benchmarks of the public rendering functions, an end-to-end samples/sec run and a baseline comparison
+"""
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+
+import cv2
+import numpy as np
+
+from cache_utils import get_cache_dir, atomic_write
+from font_utils import load_chars
+from color_utils import get_bestcolor, check_color_contrast, get_background_average_color
+from image_processor import get_horizontal_text_picture, get_vertical_text_picture
+from sample_organizer import save_organized_sample
+from augment import AugmentPipeline
+from noiser import Noiser, NoiseBank
+from rng_utils import DEFAULT_RNG
+import data_aug
+from OCR_image_generator import build_parser, GeneratorContext, new_stats, open_writer, generate_samples
+from benchmarks.synthetic_font import build_synthetic_font
+
+SEED = 1234
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DATA_AUG_FUNCS = ['apply_blur_on_output', 'apply_gauss_blur', 'apply_norm_blur', 'apply_prydown',
+                  'apply_lr_motion', 'apply_up_motion']
+NOISER_FUNCS = ['apply_gauss_noise', 'apply_uniform_noise', 'apply_sp_noise', 'apply_poisson_noise']
+
+
+def seed_all(seed=SEED):
+    """固定所有随机数种子，没有传入 rng 的函数使用 DEFAULT_RNG"""
+    random.seed(seed)
+    np.random.seed(seed)
+    cv2.setRNGSeed(seed)
+    DEFAULT_RNG.seed(seed)
+
+
+def get_bench_font(chars_file):
+    """合成字体保存在缓存目录中，字典不变时只生成一次"""
+    font_dir = os.path.join(get_cache_dir(), 'bench_fonts')
+    font_path = os.path.join(font_dir, 'BenchSynthetic.ttf')
+    if not os.path.exists(font_path):
+        build_synthetic_font(font_path, load_chars(chars_file))
+    return font_dir
+
+
+def make_cf(font_dir, output_dir, extra=()):
+    """与 main() 相同的参数，使用自带的背景、语料和合成字体"""
+    return build_parser().parse_args([
+        '--fonts_path', font_dir,
+        '--bg_path', os.path.join(ROOT, 'background'),
+        '--corpus_path', os.path.join(ROOT, 'corpus'),
+        '--chars_file', os.path.join(ROOT, 'dict5990.txt'),
+        '--color_path', os.path.join(ROOT, 'models', 'colors_new.cp'),
+        '--config_file', os.path.join(ROOT, 'noise.yaml'),
+        '--output_dir', output_dir,
+        '--seed', str(SEED)
+    ] + list(extra))
+
+
+def time_calls(func, number, warmup=3):
+    """
+    调用 func(i) number 次，记录每次的耗时
+    :return: dict，单位为微秒
+    """
+    for i in range(warmup):
+        func(i)
+    times = np.empty(number)
+    for i in range(number):
+        t = time.perf_counter()
+        func(i)
+        times[i] = time.perf_counter() - t
+    times *= 1e6
+    return {
+        'calls': number,
+        'median_us': round(float(np.median(times)), 2),
+        'mean_us': round(float(times.mean()), 2),
+        'p95_us': round(float(np.percentile(times, 95)), 2)
+    }
+
+
+def render_inputs(ctx, n=32):
+    """先渲染一组固定的样本，作为颜色、增强、噪声和保存函数的输入"""
+    seed_all()
+    cf = ctx.cf
+    crops = []
+    for i in range(n):
+        render = get_vertical_text_picture if i % 5 == 4 else get_horizontal_text_picture
+        img_path = os.path.join(ctx.img_root_path, ctx.imnames[i % len(ctx.imnames)])
+        crop, chars, font_path, render_info = render(img_path, ctx.color_lib, ctx.char_lines, ctx.fonts_list,
+                                        ctx.font_coverage, cf, bg_cache=ctx.bg_cache, font_pool=ctx.font_pool,
+                                        glyph_metrics=ctx.glyph_metrics, font_sampler=ctx.font_sampler,
+                                        glyph_atlas=ctx.glyph_atlas)
+        crops.append((crop, chars, font_path, i % 5 == 4, render_info))
+    return crops
+
+
+def run_benchmarks(number=200, e2e_samples=300, only=None):
+    """运行所有基准测试，返回结果字典"""
+    chars_file = os.path.join(ROOT, 'dict5990.txt')
+    font_dir = get_bench_font(chars_file)
+    tmp_dir = tempfile.mkdtemp(prefix='ocr_bench_')
+    results = {}
+    noise_bank = None
+    try:
+        cf = make_cf(font_dir, tmp_dir)
+        # 渲染函数会打印调试信息，测试时丢弃
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            ctx = GeneratorContext(cf)
+            crops = render_inputs(ctx)
+        n = len(crops)
+        images = [crop for crop, _, _, _, _ in crops]
+        labs = [cv2.cvtColor(img, cv2.COLOR_RGB2Lab) for img in images]
+        bg_colors = [get_background_average_color(crop) for crop, _, _, _, _ in crops]
+        img_paths = [os.path.join(ctx.img_root_path, name) for name in ctx.imnames]
+
+        def render(func):
+            def call(i):
+                return func(img_paths[i % len(img_paths)], ctx.color_lib, ctx.char_lines, ctx.fonts_list,
+                            ctx.font_coverage, cf, bg_cache=ctx.bg_cache, font_pool=ctx.font_pool,
+                            glyph_metrics=ctx.glyph_metrics, font_sampler=ctx.font_sampler,
+                            glyph_atlas=ctx.glyph_atlas)
+            return call
+
+        save_dir = os.path.join(tmp_dir, 'saved')
+        benches = {
+            'get_horizontal_text_picture': render(get_horizontal_text_picture),
+            'get_vertical_text_picture': render(get_vertical_text_picture),
+            'get_bestcolor': lambda i: get_bestcolor(ctx.color_lib, labs[i % n], cf.color_method,
+                                                     bg_color=bg_colors[i % n], min_contrast=2.5),
+            'check_color_contrast': lambda i: check_color_contrast((20, 20, 20), crops[i % n][0], min_contrast=2.5),
+            'save_organized_sample': lambda i: save_organized_sample(crops[i % n][0], crops[i % n][1], save_dir,
+                                                                     crops[i % n][2], crops[i % n][3], i,
+                                                                     crops[i % n][4]),
+        }
+        for name in NOISER_FUNCS:
+            benches['Noiser.' + name] = (lambda f: lambda i: f(images[i % n]))(getattr(ctx.noiser, name))
+        # 同样的噪声函数改为从共享内存中的噪声场取噪声
+        noise_bank = NoiseBank.create(seed=SEED)
+        bank_noiser = Noiser(ctx.flag, bank=noise_bank)
+        for name in NOISER_FUNCS:
+            benches['NoiseBank.' + name] = (lambda f: lambda i: f(images[i % n]))(getattr(bank_noiser, name))
+        for name in DATA_AUG_FUNCS:
+            benches['data_aug.' + name] = (lambda f: lambda i: f(images[i % n]))(getattr(data_aug, name))
+        # 所有增强（不含噪声）串在一起，每次处理一个新数组，与 generate_samples 中一致
+        pipeline = AugmentPipeline(ctx.flag, ctx.noiser, make_cf(font_dir, tmp_dir, [
+            '--blur', '--prydown', '--lr_motion', '--ud_motion']))
+        benches['AugmentPipeline'] = lambda i: pipeline(images[i % n].copy())
+
+        for name, func in benches.items():
+            if only and only not in name:
+                continue
+            seed_all()
+            try:
+                with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                    results[name] = time_calls(func, number)
+            except Exception as e:
+                # 出错的函数记录错误后继续测试其他函数
+                results[name] = {'error': f'{type(e).__name__}: {e}'}
+                print(f'{name:40s} {"error":>12s}  {results[name]["error"]}')
+                continue
+            print(f'{name:40s} {results[name]["median_us"]:12.1f} us')
+
+        end_to_end = None
+        if not only or only in 'end_to_end':
+            seed_all()
+            stats = new_stats()
+            labels = io.StringIO()
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                t = time.perf_counter()
+                with open_writer(cf, labels, stats) as writer:
+                    generate_samples(1, e2e_samples + 1, ctx, stats, writer)
+                seconds = time.perf_counter() - t
+            end_to_end = {
+                'samples': stats['total'],
+                'seconds': round(seconds, 3),
+                'samples_per_sec': round(stats['total'] / seconds, 2)
+            }
+            print(f'{"end_to_end":40s} {end_to_end["samples_per_sec"]:12.1f} samples/sec')
+    finally:
+        if noise_bank is not None:
+            noise_bank.close()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return {
+        'seed': SEED,
+        'number': number,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': results,
+        'end_to_end': end_to_end
+    }
+
+
+def compare(current, baseline, tolerance=0.2):
+    """
+    与基准结果比较，耗时（或吞吐量的倒数）超过基准 (1 + tolerance) 倍视为变慢
+    本次或基准中出错的项目、基准中没有的项目单独列出，不会被忽略
+    :return: (变慢的项目列表, 出错或缺少基准的项目列表)
+    """
+    regressions = []
+    problems = []
+    print(f'\n{"benchmark":40s} {"baseline":>12s} {"current":>12s} {"ratio":>8s}')
+    rows = []
+    for name, r in current['results'].items():
+        base = baseline['results'].get(name)
+        if 'error' in r:
+            problems.append(name)
+            print(f'{name:40s} {"":>12s} {"error":>12s}  {r["error"]}')
+        elif base is None:
+            problems.append(name)
+            print(f'{name:40s} {"missing":>12s} {r["median_us"]:12.1f}')
+        elif 'error' in base:
+            problems.append(name)
+            print(f'{name:40s} {"error":>12s} {r["median_us"]:12.1f}  {base["error"]}')
+        else:
+            rows.append((name, base['median_us'], r['median_us']))
+    if current.get('end_to_end'):
+        name = 'end_to_end (s/1k samples)'
+        cur = 1000 / current['end_to_end']['samples_per_sec']
+        if baseline.get('end_to_end'):
+            # 吞吐量取倒数，比值的含义与耗时一致：大于 1 表示变慢
+            rows.append((name, 1000 / baseline['end_to_end']['samples_per_sec'], cur))
+        else:
+            problems.append(name)
+            print(f'{name:40s} {"missing":>12s} {cur:12.1f}')
+    for name, base, cur in rows:
+        ratio = cur / base if base > 0 else float('inf')
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = '  SLOWER'
+            regressions.append(name)
+        elif ratio < 1 / (1 + tolerance):
+            flag = '  faster'
+        print(f'{name:40s} {base:12.1f} {cur:12.1f} {ratio:8.2f}{flag}')
+    return regressions, problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the OCR image generator')
+    parser.add_argument('--number', type=int, default=200, help='Calls per micro benchmark')
+    parser.add_argument('--e2e_samples', type=int, default=300, help='Samples rendered in the end-to-end run')
+    parser.add_argument('--only', type=str, default=None, help='Only run benchmarks whose name contains this')
+    parser.add_argument('--baseline', type=str, default=BASELINE, help='Baseline JSON to compare against')
+    parser.add_argument('--save_baseline', action='store_true', help='Overwrite the baseline with this run')
+    parser.add_argument('--output', type=str, default=None, help='Also write the results of this run to this JSON')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed slowdown ratio before flagging')
+    parser.add_argument('--check', action='store_true', help='Exit with status 1 when a benchmark got slower, failed or has no baseline')
+    args = parser.parse_args()
+
+    current = run_benchmarks(args.number, args.e2e_samples, args.only)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(current, f, indent=2)
+
+    if args.save_baseline:
+        errors = [name for name, r in current['results'].items() if 'error' in r]
+        if errors:
+            # 出错的项目没有耗时，写入基准后之后的比较都无法发现它的变化
+            print(f'Baseline not saved, {len(errors)} benchmark(s) failed: {", ".join(errors)}')
+            sys.exit(1)
+        with atomic_write(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(current, f, indent=2)
+        print(f'Baseline saved to {args.baseline}')
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f'No baseline at {args.baseline}, run with --save_baseline to create one')
+        return
+    with open(args.baseline, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    regressions, problems = compare(current, baseline, args.tolerance)
+    if regressions:
+        print(f'\n{len(regressions)} benchmark(s) slower than baseline: {", ".join(regressions)}')
+    if problems:
+        print(f'\n{len(problems)} benchmark(s) failed or missing from baseline: {", ".join(problems)}')
+    if args.check and (regressions or problems):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic font utilities for the benchmarks
+Contains a deterministic TrueType font builder covering every char of the dict file
+"""
+import os
+
+from fontTools.fontBuilder import FontBuilder
+from fontTools.pens.ttGlyphPen import TTGlyphPen
+
+from cache_utils import atomic_write
+
+UNITS_PER_EM = 1000
+ASCENT = 880
+DESCENT = -120
+
+
+def _draw_glyph(cp):
+    """
+    由码位决定的字形：3x3 网格中按码位的二进制位点亮若干笔画，再加一条横笔，
+    每个字的墨水覆盖率和真实字体接近，不同字的形状不同
+    """
+    pen = TTGlyphPen(None)
+    cell = 260
+    margin = 80
+    bits = cp * 2654435761 & 0x1ff
+    for k in range(9):
+        if bits >> k & 1:
+            x = margin + (k % 3) * cell
+            y = margin + (k // 3) * cell
+            pen.moveTo((x, y))
+            pen.lineTo((x, y + cell - 60))
+            pen.lineTo((x + cell - 60, y + cell - 60))
+            pen.lineTo((x + cell - 60, y))
+            pen.closePath()
+    pen.moveTo((margin, 420))
+    pen.lineTo((margin, 480))
+    pen.lineTo((UNITS_PER_EM - margin, 480))
+    pen.lineTo((UNITS_PER_EM - margin, 420))
+    pen.closePath()
+    return pen.glyph()
+
+
+def build_synthetic_font(path, chars, family='BenchSynthetic'):
+    """生成覆盖 chars 中所有字符的 TrueType 字体，内容只由 chars 决定"""
+    chars = sorted(set(c for c in chars if not c.isspace()))
+    glyph_order = ['.notdef', 'space'] + ['uni%04X' % ord(c) for c in chars]
+    cmap = {ord(' '): 'space'}
+    cmap.update({ord(c): 'uni%04X' % ord(c) for c in chars})
+
+    empty = TTGlyphPen(None).glyph()
+    glyphs = {'.notdef': _draw_glyph(0), 'space': empty}
+    glyphs.update({'uni%04X' % ord(c): _draw_glyph(ord(c)) for c in chars})
+    metrics = {name: (UNITS_PER_EM, 0) for name in glyph_order}
+    metrics['space'] = (UNITS_PER_EM // 3, 0)
+
+    fb = FontBuilder(UNITS_PER_EM, isTTF=True)
+    fb.setupGlyphOrder(glyph_order)
+    fb.setupCharacterMap(cmap)
+    fb.setupGlyf(glyphs)
+    fb.setupHorizontalMetrics(metrics)
+    fb.setupHorizontalHeader(ascent=ASCENT, descent=DESCENT)
+    fb.setupNameTable({'familyName': family, 'styleName': 'Regular'})
+    fb.setupOS2(sTypoAscender=ASCENT, sTypoDescender=DESCENT, usWinAscent=ASCENT, usWinDescent=-DESCENT)
+    fb.setupPost()
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with atomic_write(path) as f:
+        fb.save(f)
+    return path
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+Cache utilities for OCR image generation
+Contains the shared on-disk cache directory, cache key helpers and atomic file writes
+"""
+import os
+import hashlib
+from contextlib import contextmanager
+
+
+def get_cache_dir():
+    """磁盘缓存目录，所有进程共用"""
+    cache_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '../', '.caches'))
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+def file_key(path, *extra):
+    """
+    由文件路径、大小和修改时间生成缓存键，文件变化后缓存自动失效
+    :param extra: 参与计算的其他参数
+    """
+    st = os.stat(path)
+    string = '\t'.join([os.path.abspath(path), str(st.st_size), str(st.st_mtime_ns)] + [str(x) for x in extra])
+    return hashlib.md5(string.encode('utf-8')).hexdigest()
+
+
+@contextmanager
+def atomic_write(path, mode='wb', encoding=None):
+    """
+    原子地写文件：先写临时文件，flush 并 fsync 后再改名为 path，
+    出错时删除临时文件并重新抛出，其他进程和中断后续跑时都不会读到写了一半的文件
+        with atomic_write(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+    """
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tmp, mode, encoding=encoding) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
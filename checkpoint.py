@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Checkpoint utilities for OCR image generation
+Contains the resume manifest written next to labels.txt
+"""
+import os
+import json
+import time
+
+from cache_utils import atomic_write
+
+CHECKPOINT_FILE = 'checkpoint.json'
+VERSION = 2
+
+
+def checkpoint_path(output_dir, name=CHECKPOINT_FILE):
+    return os.path.join(output_dir, name)
+
+
+def save_checkpoint(output_dir, last_index, labels_size, stats, seed, name=CHECKPOINT_FILE):
+    """
+    原子地更新断点文件：先写临时文件再改名，中断时不会留下写了一半的文件
+    :param last_index: 最后一个写入标签的样本编号
+    :param labels_size: 此时 labels.txt 的字节数，续跑时截断到这个长度
+    :param seed: 运行种子，样本的随机数只由 (种子, 编号) 决定，续跑时不需要保存随机数状态
+    :param name: 断点文件名，多节点生成时每个节点各用一个
+    """
+    path = checkpoint_path(output_dir, name)
+    data = {
+        'version': VERSION,
+        'last_index': last_index,
+        'labels_size': labels_size,
+        'stats': dict(stats, fonts=sorted(stats['fonts'])),
+        'seed': seed,
+        'time': time.time()
+    }
+    with atomic_write(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+
+
+def load_checkpoint(output_dir, name=CHECKPOINT_FILE):
+    """读取断点文件，不存在或无法解析时返回 None"""
+    path = checkpoint_path(output_dir, name)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f'Could not load checkpoint {path}: {e}')
+        return None
+    if data.get('version') != VERSION:
+        return None
+    data['stats']['fonts'] = set(data['stats']['fonts'])
+    return data
+
+
+def read_last_line(path, block_size=4096):
+    """从文件末尾向前读取最后一个非空行，不需要读入整个文件"""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        data = b''
+        pos = end
+        while pos > 0:
+            step = min(block_size, pos)
+            pos -= step
+            f.seek(pos)
+            data = f.read(step) + data
+            lines = data.rstrip(b'\r\n').split(b'\n')
+            if len(lines) > 1 or pos == 0:
+                return lines[-1].decode('utf-8')
+    return ''
+
+
+def resume_labels(output_dir, labels_path, name=CHECKPOINT_FILE):
+    """
+    确定续跑的起始位置
+    有断点文件时把 labels.txt 截断到断点记录的长度（丢弃断点之后写入的标签），
+    否则从 labels.txt 的最后一行读取编号
+    :return: (最后一个样本的编号, 断点数据或 None)
+    """
+    if not os.path.exists(labels_path):
+        return 0, None
+
+    checkpoint = load_checkpoint(output_dir, name)
+    size = os.path.getsize(labels_path)
+    if checkpoint is not None and checkpoint['labels_size'] <= size:
+        if checkpoint['labels_size'] < size:
+            with open(labels_path, 'r+b') as f:
+                f.truncate(checkpoint['labels_size'])
+        return checkpoint['last_index'], checkpoint
+
+    last_line = read_last_line(labels_path)
+    if not last_line:
+        return 0, None
+    return int(last_line.split('\t')[0]), None
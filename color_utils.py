@@ -7,7 +7,10 @@ import cv2
 import numpy as np
 import pickle
 import os
-from sklearn.cluster import KMeans
+import hashlib
+
+from cache_utils import atomic_write
+from rng_utils import get_rng
 
 
 # 自定义 Unpickler 修复模块名
@@ -90,6 +93,11 @@ class FontColor(object):
         # computations:
         self.colorsRGB = np.r_[self.colorsRGB[:, 0:3], self.colorsRGB[:, 6:9]].astype('uint8')
         self.colorsLAB = np.squeeze(cv2.cvtColor(self.colorsRGB[None, :, :], cv2.COLOR_RGB2Lab))
+
+        # Lab 空间索引和每种颜色的相对亮度，保存在 colors_new.npy 旁边
+        index_file = os.path.splitext(npy_file)[0] + '.index.npz'
+        self.index = PaletteIndex.load_or_build(index_file, self.colorsLAB, self.colorsRGB)
+        self.luminance = self.index.luminance
     
     def _create_default_colors(self):
         """Create a default color palette if the pickle file cannot be loaded"""
@@ -119,49 +127,204 @@ def RGB2Lab(rgb):
         return cv2.cvtColor(rgb, cv2.COLOR_RGB2Lab)
 
 
-def get_bestcolor(color_lib, crop_lab):
+def kmeans_colors(labs, n_clusters=8, n_iter=10, rng=None):
+    """
+    固定迭代次数的 NumPy k-means，用 k-means++ 初始化，提前收敛时停止
+    Returns: 聚类中心 (k, 3) 和每类的像素数 (k,)
+    """
+    rng = get_rng(rng)
+    labs = labs.astype(np.float32)
+    n = labs.shape[0]
+    k = min(n_clusters, n)
+    labs_t = np.ascontiguousarray(labs.T)
+    labs_sq = np.einsum('ij,ij->i', labs, labs)
+
+    # k-means++ 初始化：依次按到已选中心的距离平方加权抽取新的中心
+    centers = np.empty((k, 3), dtype=np.float32)
+    centers[0] = labs[rng.np.integers(n)]
+    closest = labs_sq - 2 * centers[0].dot(labs_t) + centers[0].dot(centers[0])
+    for c in range(1, k):
+        total = closest.sum()
+        if total <= 0:  # 不同的颜色少于 k 种
+            centers = centers[:c]
+            break
+        centers[c] = labs[min(np.searchsorted(np.cumsum(closest), rng.np.random() * total), n - 1)]
+        closest = np.minimum(closest, labs_sq - 2 * centers[c].dot(labs_t) + centers[c].dot(centers[c]))
+    k = centers.shape[0]
+
+    labels = None
+    for _ in range(n_iter + 1):
+        # 距离矩阵为 (k, n)，沿第 0 维取最近的中心
+        dist = (centers ** 2).sum(axis=1)[:, None] - 2 * centers.dot(labs_t)
+        new_labels = dist.argmin(axis=0)
+        if labels is not None and np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+        counts = np.bincount(labels, minlength=k)
+        nonempty = counts > 0
+        for ch in range(3):
+            sums = np.bincount(labels, weights=labs_t[ch], minlength=k)
+            centers[nonempty, ch] = sums[nonempty] / counts[nonempty]
+
+    counts = np.bincount(labels, minlength=k)
+    return centers[counts > 0], counts[counts > 0]
+
+
+def median_cut_colors(labs, n_clusters=8, rng=None):
+    """
+    中位切分量化：每次把像素跨度最大的盒子沿最宽的通道从中位数处切开，结果是确定的，不使用 rng
+    Returns: 聚类中心 (k, 3) 和每类的像素数 (k,)
+    """
+    boxes = [labs]
+    while len(boxes) < n_clusters:
+        spans = [np.ptp(b, axis=0) if len(b) > 1 else np.zeros(3) for b in boxes]
+        i = int(np.argmax([sp.max() for sp in spans]))
+        if spans[i].max() == 0:  # 所有盒子都只剩一种颜色
+            break
+        box = boxes.pop(i)
+        ch = int(np.argmax(spans[i]))
+        order = np.argsort(box[:, ch], kind='stable')
+        half = len(order) // 2
+        boxes.append(box[order[:half]])
+        boxes.append(box[order[half:]])
+
+    centers = np.array([b.mean(axis=0) for b in boxes], dtype=np.float32)
+    counts = np.array([len(b) for b in boxes])
+    return centers, counts
+
+
+def sklearn_kmeans_colors(labs, n_clusters=8, rng=None):
+    """sklearn KMeans 聚类，结果作为其他方法的参照"""
+    from sklearn.cluster import KMeans
+
+    clf = KMeans(n_clusters=n_clusters, random_state=get_rng(rng).randrange(2 ** 31))
+    clf.fit(labs)
+    #clf.labels_是每个聚类中心的数据（假设有八个类，则每个数据标签属于每个类的数据格式就是从0-8），clf.cluster_centers_是每个聚类中心
+    counts = np.bincount(clf.labels_, minlength=n_clusters)
+    return clf.cluster_centers_, counts
+
+
+# 主色提取方法，可通过 --color_method 选择
+DOMINANT_COLOR_METHODS = {
+    'kmeans': kmeans_colors,
+    'median_cut': median_cut_colors,
+    'sklearn': sklearn_kmeans_colors,
+}
+
+
+def get_dominant_colors(labs, n_clusters=8, method='kmeans', rng=None):
+    """
+    提取 Lab 像素的主色
+    Returns: 聚类中心 (k, 3) 和每类的像素数 (k,)
+    """
+    if method not in DOMINANT_COLOR_METHODS:
+        raise ValueError('Unknown dominant color method: %s' % method)
+    return DOMINANT_COLOR_METHODS[method](labs, n_clusters, rng=rng)
+
+
+# 聚类中心按像素数从多到少的权重，越主要的背景颜色，字体颜色越要远离它
+CLUSTER_WEIGHTS = np.array([1, 0.8, 0.6, 0.4, 0.2, 0.1, 0.05, 0.01], dtype=np.float32)
+
+
+def relative_luminance(rgb):
+    """批量计算 RGB 颜色的相对亮度，rgb 的最后一维为 (r, g, b)"""
+    c = np.asarray(rgb, dtype=np.float64) / 255.0
+    c = np.where(c <= 0.03928, c / 12.92, ((c + 0.055) / 1.055) ** 2.4)
+    return c.dot([0.2126, 0.7152, 0.0722])
+
+
+class PaletteIndex(object):
+    """
+    色彩库的查询表：float32 Lab 颜色（及其平方和）和每种颜色的相对亮度。
+    查询离聚类中心最远的颜色时一次算出整个色彩库的得分，再用 argpartition 取前 top_k。
+    top_k 是色彩库的 40%，按 Lab 网格剪枝几乎剪不掉颜色，反而比直接计算慢，所以不做剪枝。
+    """
+    VERSION = 2
+
+    def __init__(self, digest, lab, luminance):
+        self.digest = digest
+        self.lab = lab                # 按色彩库顺序的 Lab 颜色
+        self.lab_sq = np.einsum('ij,ij->i', lab, lab)
+        self.luminance = luminance    # 按色彩库顺序的相对亮度
+
+    @staticmethod
+    def palette_digest(colors_rgb):
+        return hashlib.md5(np.ascontiguousarray(colors_rgb).tobytes()).hexdigest()
+
+    @classmethod
+    def build(cls, colors_lab, colors_rgb):
+        """根据色彩库建立查询表"""
+        return cls(cls.palette_digest(colors_rgb), colors_lab.astype(np.float32), relative_luminance(colors_rgb))
+
+    @classmethod
+    def load_or_build(cls, index_file, colors_lab, colors_rgb):
+        """读取保存的查询表，色彩库变化或文件不存在时重新建立并保存"""
+        digest = cls.palette_digest(colors_rgb)
+        if os.path.exists(index_file):
+            try:
+                data = np.load(index_file)
+                if int(data['version']) == cls.VERSION and str(data['digest']) == digest:
+                    return cls(digest, data['lab'], data['luminance'])
+            except Exception as e:
+                print(f"Error loading palette index {index_file}: {e}")
+
+        index = cls.build(colors_lab, colors_rgb)
+        # 先写临时文件再改名，多个进程同时建立索引时不会读到写了一半的文件
+        try:
+            with atomic_write(index_file) as f:
+                np.savez(f, version=cls.VERSION, digest=digest, lab=index.lab, luminance=index.luminance)
+            print(f"Saved palette index to {index_file}")
+        except OSError as e:
+            print(f"Could not save palette index {index_file}: {e}")
+        return index
+
+    def score(self, centers, weights):
+        """每种颜色到各聚类中心的加权距离之和，|x - c|^2 = |x|^2 - 2 x·c + |c|^2 用矩阵乘法一次算出"""
+        d2 = self.lab_sq[:, None] - 2 * self.lab.dot(centers.T) + np.einsum('ij,ij->i', centers, centers)[None, :]
+        np.maximum(d2, 0, out=d2)
+        return np.sqrt(d2, out=d2).dot(weights)
+
+    def farthest(self, centers, weights, top_k):
+        """
+        返回到聚类中心加权距离之和最大的 top_k 种颜色在色彩库中的编号
+        Args:
+            centers: 聚类中心 (k, 3)
+            weights: 每个聚类中心的权重 (k,)
+            top_k: 返回的颜色数
+        """
+        centers = np.asarray(centers, dtype=np.float32)
+        weights = np.asarray(weights, dtype=np.float32)
+        top_k = min(top_k, len(self.lab))
+        scores = self.score(centers, weights)
+        return np.argpartition(-scores, top_k - 1)[:top_k]
+
+
+def get_bestcolor(color_lib, crop_lab, method='kmeans', top_ratio=0.4, bg_color=None, min_contrast=None, rng=None):
     """分析图片，获取最适宜的字体颜色"""
     if crop_lab.size > 4800:
         crop_lab = cv2.resize(crop_lab,(100,16))  #将图像转成100*16大小的图片
     labs = np.reshape(np.asarray(crop_lab), (-1, 3))         #len(labs)长度为160   
-    clf = KMeans(n_clusters=8)
-    clf.fit(labs)
-    
-    #clf.labels_是每个聚类中心的数据（假设有八个类，则每个数据标签属于每个类的数据格式就是从0-8），clf.cluster_centers_是每个聚类中心   
-    total = [0] * 8
-   
-    for i in clf.labels_:
-        total[i] = total[i] + 1            #计算每个类中总共有多少个数据
- 
-    clus_result = [[i, j] for i, j in zip(clf.cluster_centers_, total)]  #聚类中心，是一个长度为8的数组
-    clus_result.sort(key=lambda x: x[1], reverse=True)    #八个类似这样的数组，第一个数组表示类中心，第二个数字表示属于该类中心的一共有多少数据[[array([242.55732946, 128.1509434 , 122.29608128]), 689], [array([245.03461538, 128.59230769, 125.88846154]), 260],，，，]
-  
-    color_sample = random.sample(range(color_lib.colorsLAB.shape[0]), 500)   # 范围是（0,9882），随机从这些数字里面选取500个
+    centers, total = get_dominant_colors(labs, 8, method, rng)   #total 是每个类中总共有多少个数据
 
-    
-    def caculate_distance(color_lab, clus_result):
-        weight = [1, 0.8, 0.6, 0.4, 0.2, 0.1, 0.05, 0.01]
-        d = 0
-        for c, w in zip(clus_result, weight):
-
-            #计算八个聚类中心和当前所选取颜色距离的标准差之和，每个随机选取的颜色当前聚类中心的差值
-            d = d + np.linalg.norm(c[0] - color_lab)           
-        return d
- 
-    color_dis = list(map(lambda x: [caculate_distance(color_lib.colorsLAB[x], clus_result), x], color_sample))   #将color_sample中的每个参数当成x传入函数内,color_lib.colorsLAB[x]是一个元组(r,g,b)也就是字体库里面的颜色
-    #color_dis 是一个长度为500的列表[[x,y],[],,,,,]，其中[x,y]其中x表示背景色和当前颜色的距离，y表示该颜色的色号  
-    color_dis.sort(key=lambda x: x[0], reverse=True)
-    color_num = color_dis[0:200]
-    color_l = random.choice(color_num)[1]
-    #print('color_dis',color_l)
-    #color_num=random.choice(color_dis[0:300])
-    #print('color_dis[0][1]',color_dis[0][1])
-    return tuple(color_lib.colorsRGB[color_l])
-    #return tuple(color_lib.colorsRGB[color_dis[0][1]])
+    # 聚类中心按像素数从多到少排列，与权重一一对应
+    order = np.argsort(-np.asarray(total), kind='stable')
+    centers = np.asarray(centers)[order]
 
+    # 从整个色彩库中得分最高的 top_ratio 部分里随机选一种颜色
+    top_k = max(1, int(len(color_lib.colorsRGB) * top_ratio))
+    color_num = color_lib.index.farthest(centers, CLUSTER_WEIGHTS[:len(centers)], top_k)
+
+    # 给出背景颜色时，预先去掉与背景对比度不足的颜色
+    if bg_color is not None and min_contrast is not None:
+        lum = color_lib.luminance[color_num]
+        bg_lum = relative_luminance(bg_color)
+        contrast = (np.maximum(lum, bg_lum) + 0.05) / (np.minimum(lum, bg_lum) + 0.05)
+        if np.any(contrast >= min_contrast):
+            color_num = color_num[contrast >= min_contrast]
+
+    color_l = get_rng(rng).choice(color_num)
+    return tuple(color_lib.colorsRGB[color_l])
 
-# Import random for get_bestcolor function
-import random
 
 
 def calculate_color_contrast(text_color, background_color):
@@ -207,16 +370,18 @@ def get_background_average_color(crop_img):
     return tuple(avg_color.astype(int))
 
 
-def check_color_contrast(text_color, crop_img, min_contrast=3.0):
+def check_color_contrast(text_color, crop_img, min_contrast=3.0, bg_color=None):
     """
     检查文字和背景的对比度是否足够
     Args:
         text_color: 文字颜色 RGB元组
         crop_img: 背景图片 PIL Image对象
         min_contrast: 最小对比度阈值，默认3.0
+        bg_color: 已算好的背景平均颜色，为 None 时由 crop_img 计算
     Returns:
         bool: True表示对比度足够，False表示对比度不足
     """
-    bg_color = get_background_average_color(crop_img)
+    if bg_color is None:
+        bg_color = get_background_average_color(crop_img)
     contrast = calculate_color_contrast(text_color, bg_color)
     return contrast >= min_contrast
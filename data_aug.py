@@ -1,7 +1,6 @@
 #!/usr/env/bin python3
 import glob
 import os
-import random
 
 import cv2
 
@@ -9,67 +8,85 @@ import numpy as np
 import hashlib
 import sys
 
+from rng_utils import get_rng
 
-def prob(percent):
+
+def prob(percent, rng=None):
     """
     percent: 0 ~ 1, e.g: 如果 percent=0.1，有 10% 的可能性
+    rng: 随机数生成器，见 rng_utils.SampleRandom
     """
     assert 0 <= percent <= 1
-    if random.uniform(0, 1) <= percent:
+    if get_rng(rng).uniform(0, 1) <= percent:
         return True
     return False
 
 
-def apply_blur_on_output(img):
-    if prob(0.5):
-        return apply_gauss_blur(img, [3, 5])
+def apply_blur_on_output(img, dst=None, rng=None):
+    """dst: 输出数组，可以就是 img（原地处理）"""
+    if prob(0.5, rng):
+        return apply_gauss_blur(img, [3, 5], dst=dst, rng=rng)
     else:
-        return apply_norm_blur(img)
+        return apply_norm_blur(img, dst=dst, rng=rng)
 
-def apply_gauss_blur(img, ks=None):
+def apply_gauss_blur(img, ks=None, dst=None, rng=None):
+    rng = get_rng(rng)
     if ks is None:
         ks = [7, 9, 11, 13]
-    ksize = random.choice(ks)
+    ksize = rng.choice(ks)
 
     sigmas = [0, 1, 2, 3, 4, 5, 6, 7]
     sigma = 0
     if ksize <= 3:
-        sigma = random.choice(sigmas)
-    img = cv2.GaussianBlur(img, (ksize, ksize), sigma)
+        sigma = rng.choice(sigmas)
+    img = cv2.GaussianBlur(img, (ksize, ksize), sigma, dst=dst)
     return img
 
-def apply_norm_blur(img, ks=None):
+def apply_norm_blur(img, ks=None, dst=None, rng=None):
     # kernel == 1, the output image will be the same
     if ks is None:
         ks = [2, 3]
-    kernel = random.choice(ks)
-    img = cv2.blur(img, (kernel, kernel))
+    kernel = get_rng(rng).choice(ks)
+    img = cv2.blur(img, (kernel, kernel), dst=dst)
     return img
 
-def apply_prydown(img):
+def apply_prydown(img, dst=None, scratch=None, rng=None):
     """
     模糊图像，模拟小图片放大的效果
+    scratch: 一维 uint8 缓冲区，不小于 img.size 时缩小后的图片直接写在里面
     """
-    scale = random.uniform(1, 1.5)
+    scale = get_rng(rng).uniform(1, 1.5)
     height = img.shape[0]
     width = img.shape[1]
 
-    out = cv2.resize(img, (int(width / scale), int(height / scale)), interpolation=cv2.INTER_AREA)
-    return cv2.resize(out, (width, height), interpolation=cv2.INTER_AREA)
+    small_w, small_h = int(width / scale), int(height / scale)
+    small = None
+    if scratch is not None and scratch.size >= img.size and img.dtype == scratch.dtype:
+        shape = (small_h, small_w) + img.shape[2:]
+        small = scratch[:int(np.prod(shape))].reshape(shape)
+    out = cv2.resize(img, (small_w, small_h), dst=small, interpolation=cv2.INTER_AREA)
+    return cv2.resize(out, (width, height), dst=dst, interpolation=cv2.INTER_AREA)
+
 
-def apply_lr_motion(image):    
-    kernel_size = 5
+def motion_kernel(kernel_size, vertical=False):
     kernel_motion_blur = np.zeros((kernel_size, kernel_size))
-    kernel_motion_blur[int((kernel_size - 1) / 2), :] = np.ones(kernel_size)
-    kernel_motion_blur = kernel_motion_blur / kernel_size
-    image = cv2.filter2D(image, -1, kernel_motion_blur)
+    if vertical:
+        kernel_motion_blur[:, int((kernel_size - 1) / 2)] = np.ones(kernel_size)
+    else:
+        kernel_motion_blur[int((kernel_size - 1) / 2), :] = np.ones(kernel_size)
+    return kernel_motion_blur / kernel_size
+
+
+# 运动模糊的卷积核是固定的，只生成一次
+LR_MOTION_KERNEL = motion_kernel(5)
+UD_MOTION_KERNEL = motion_kernel(9, vertical=True)
+
+
+def apply_lr_motion(image, dst=None):
+    image = cv2.filter2D(image, -1, LR_MOTION_KERNEL, dst=dst)
     return image
 
 
-def apply_up_motion(image): 
-    kernel_size = 9
-    kernel_motion_blur = np.zeros((kernel_size, kernel_size))
-    kernel_motion_blur[:, int((kernel_size - 1) / 2)] = np.ones(kernel_size)
-    kernel_motion_blur = kernel_motion_blur / kernel_size
-    image = cv2.filter2D(image, -1, kernel_motion_blur)
+def apply_up_motion(image, dst=None):
+    image = cv2.filter2D(image, -1, UD_MOTION_KERNEL, dst=dst)
     return image
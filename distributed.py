@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Distributed generation utilities for OCR image generation
+Contains the per-node index ranges and file names of --shard_id / --num_shards,
+and the merge of the per-node labels files into one labels.txt with a stats summary
+
+Merge after all nodes have finished:
+    python distributed.py --output_dir ./organized_output/
+"""
+import os
+import re
+import json
+import heapq
+import argparse
+
+from cache_utils import atomic_write
+from checkpoint import CHECKPOINT_FILE
+
+LABELS_FILE = 'labels.txt'
+STATS_FILE = 'stats.json'
+NODE_LABELS_RE = re.compile(r'^labels_(\d{5})-of-(\d{5})\.txt$')
+
+
+def node_suffix(shard_id, num_shards):
+    return f'{shard_id:05d}-of-{num_shards:05d}'
+
+
+def node_labels_name(shard_id, num_shards):
+    """节点自己的标签文件名，单节点时仍为 labels.txt"""
+    if num_shards <= 1:
+        return LABELS_FILE
+    return f'labels_{node_suffix(shard_id, num_shards)}.txt'
+
+
+def node_checkpoint_name(shard_id, num_shards):
+    """节点自己的断点文件名，单节点时仍为 checkpoint.json"""
+    if num_shards <= 1:
+        return CHECKPOINT_FILE
+    return f'checkpoint_{node_suffix(shard_id, num_shards)}.json'
+
+
+def node_range(shard_id, num_shards, num_img, last_index=0):
+    """
+    节点负责的样本编号区间 [start, end)
+    单节点时从 last_index 之后再生成 num_img 个；多节点时第 k 个节点固定负责
+    [k * num_img + 1, (k + 1) * num_img + 1)，续跑时只补齐区间内剩下的部分
+    """
+    if num_shards <= 1:
+        return last_index + 1, last_index + num_img + 1
+    first = shard_id * num_img + 1
+    return max(first, last_index + 1), first + num_img
+
+
+def find_node_labels(output_dir):
+    """
+    找出所有节点的标签文件
+    :return: 按节点编号排序的文件路径列表
+    """
+    found = {}
+    num_shards = None
+    for name in os.listdir(output_dir):
+        m = NODE_LABELS_RE.match(name)
+        if m is None:
+            continue
+        shard_id, n = int(m.group(1)), int(m.group(2))
+        if num_shards is not None and n != num_shards:
+            raise ValueError(f'Labels files from runs with different --num_shards in {output_dir}')
+        num_shards = n
+        found[shard_id] = os.path.join(output_dir, name)
+    if not found:
+        raise ValueError(f'No labels_xxxxx-of-xxxxx.txt files in {output_dir}')
+    missing = [i for i in range(num_shards) if i not in found]
+    if missing:
+        raise ValueError(f'Missing labels of shards {missing} (of {num_shards})')
+    return [found[i] for i in range(num_shards)]
+
+
+def iter_labels(path):
+    """逐行读取标签文件，返回 (编号, 行)"""
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield int(line.split('\t', 1)[0]), line
+
+
+def new_summary():
+    return {
+        'total': 0,
+        'horizontal': 0,
+        'vertical': 0,
+        'black_on_white': 0,
+        'white_on_black': 0,
+        'fonts': {},
+        'first_index': None,
+        'last_index': None
+    }
+
+
+def count_line(summary, index, line):
+    """标签行：编号、路径、文字、字体、方向、颜色类型，文字中可能含有制表符"""
+    fields = line.rstrip('\n').split('\t')
+    font_name, direction, color_type = fields[-3:]
+    summary['total'] += 1
+    summary['horizontal' if direction == 'horizontal' else 'vertical'] += 1
+    summary[color_type] = summary.get(color_type, 0) + 1
+    summary['fonts'][font_name] = summary['fonts'].get(font_name, 0) + 1
+    if summary['first_index'] is None:
+        summary['first_index'] = index
+    summary['last_index'] = index
+
+
+def merge_labels(output_dir, paths=None):
+    """
+    把各节点的标签文件按编号归并成一个 labels.txt，同时统计样本信息写入 stats.json
+    每个文件只顺序读一遍，内存中同时只有每个文件的一行
+    :return: 统计信息
+    """
+    if paths is None:
+        paths = find_node_labels(output_dir)
+    summary = new_summary()
+    labels_path = os.path.join(output_dir, LABELS_FILE)
+    last = None
+    with atomic_write(labels_path, 'w', encoding='utf-8') as out:
+        for index, line in heapq.merge(*[iter_labels(p) for p in paths], key=lambda x: x[0]):
+            if last is not None and index <= last:
+                raise ValueError(f'Sample {index} appears more than once or out of order')
+            last = index
+            out.write(line if line.endswith('\n') else line + '\n')
+            count_line(summary, index, line)
+
+    summary['nodes'] = len(paths)
+    stats_path = os.path.join(output_dir, STATS_FILE)
+    with atomic_write(stats_path, 'w', encoding='utf-8') as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge the labels files written with --shard_id / --num_shards')
+    parser.add_argument('--output_dir', type=str, default='./organized_output/',
+                        help='The --output_dir shared by all nodes')
+    args = parser.parse_args()
+
+    try:
+        summary = merge_labels(args.output_dir)
+    except ValueError as e:
+        parser.error(str(e))
+    print(f'Merged {summary["nodes"]} labels files: {summary["total"]} samples '
+          f'({summary["first_index"]} - {summary["last_index"]})')
+    print(f'Horizontal: {summary["horizontal"]}, Vertical: {summary["vertical"]}')
+    print(f'Black on white: {summary["black_on_white"]}, White on black: {summary["white_on_black"]}')
+    print(f'Fonts used: {len(summary["fonts"])}')
+    print(f'Stats written to {os.path.join(args.output_dir, STATS_FILE)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -4,14 +4,19 @@ Font utilities for OCR image generation
 Contains font handling and character support functions
 """
 import os
-import pickle
 import hashlib
+from collections import OrderedDict
+import numpy as np
 from fontTools.ttLib import TTCollection, TTFont
+from PIL import ImageFont
+
+from cache_utils import get_cache_dir, file_key, atomic_write
+from rng_utils import get_rng
 
 
 def get_fonts(fonts_path):
     """获取字体文件列表"""
-    font_files = os.listdir(fonts_path)
+    font_files = sorted(os.listdir(fonts_path))
     fonts_list = []
     for font_file in font_files:
         if font_file in (".gitignore",):
@@ -21,40 +26,331 @@ def get_fonts(fonts_path):
     return fonts_list
 
 
-def chose_font(fonts, font_sizes):
+class FontPool(object):
+    """
+    按 (font_path, size) 缓存 ImageFont 对象，避免重复解析字体文件。
+    每个进程一个实例，超出容量时淘汰最久未使用的字体。
+    """
+
+    def __init__(self, max_fonts=512):
+        self.max_fonts = max_fonts
+        self.hits = 0
+        self.misses = 0
+        self._fonts = OrderedDict()
+
+    def __len__(self):
+        return len(self._fonts)
+
+    def get(self, font_path, size):
+        """获取指定大小的字体"""
+        key = (font_path, size)
+        font = self._fonts.get(key)
+        if font is not None:
+            self._fonts.move_to_end(key)
+            self.hits += 1
+            return font
+
+        self.misses += 1
+        font = ImageFont.truetype(font_path, size)
+        self._fonts[key] = font
+        if len(self._fonts) > self.max_fonts:
+            self._fonts.popitem(last=False)
+        return font
+
+    def warmup(self, fonts_list, min_size, max_size):
+        """预先加载每种字体在 [min_size, max_size] 内的所有大小"""
+        total = len(fonts_list) * (max_size - min_size + 1)
+        if total > self.max_fonts:
+            print('Font pool size %d is smaller than %d fonts to warm up, only the first %d are loaded'
+                  % (self.max_fonts, total, self.max_fonts))
+        n = 0
+        for font_path in fonts_list:
+            for size in range(min_size, max_size + 1):
+                if n >= self.max_fonts:
+                    return
+                key = (font_path, size)
+                if key not in self._fonts:
+                    self._fonts[key] = ImageFont.truetype(font_path, size)
+                n += 1
+
+
+class GlyphMetrics(object):
+    """
+    字形度量表：(字体文件哈希, 字号, 码位) -> (宽, 高, x 偏移, y 偏移)，即 font.getsize(c) 和 font.getoffset(c)。
+    按需填充，每种字体保存为一个 int32 数组文件，之后的运行和其他进程可以直接读取。
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir or get_cache_dir()
+        self.hits = 0
+        self.misses = 0
+        self._font_hash = {}
+        self._tables = {}
+        self._dirty = set()
+
+    def font_hash(self, font_path):
+        """字体文件内容的 MD5，相同的字体文件在不同路径下共用一张表"""
+        digest = self._font_hash.get(font_path)
+        if digest is None:
+            m = hashlib.md5()
+            with open(font_path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    m.update(block)
+            digest = self._font_hash[font_path] = m.hexdigest()
+        return digest
+
+    def _table_file(self, digest):
+        return os.path.join(self.cache_dir, 'glyphs_%s.npy' % digest)
+
+    @staticmethod
+    def _read_table(table_file):
+        """读取度量文件，每行为 (size, codepoint, w, h, offset_x, offset_y)"""
+        table = {}
+        if os.path.exists(table_file):
+            try:
+                for row in np.load(table_file).tolist():
+                    table[(row[0], row[1])] = ((row[2], row[3]), (row[4], row[5]))
+            except (OSError, ValueError) as e:
+                print('Could not load glyph metrics %s: %s' % (table_file, e))
+        return table
+
+    def _table(self, font_path):
+        digest = self.font_hash(font_path)
+        table = self._tables.get(digest)
+        if table is None:
+            table = self._tables[digest] = self._read_table(self._table_file(digest))
+        return digest, table
+
+    def get(self, font, font_path, size, c):
+        """返回字符 c 的 (w, h) 和 (offset_x, offset_y)"""
+        digest, table = self._table(font_path)
+        key = (size, ord(c))
+        metrics = table.get(key)
+        if metrics is not None:
+            self.hits += 1
+            return metrics
+
+        self.misses += 1
+        metrics = table[key] = (tuple(font.getsize(c)), tuple(font.getoffset(c)))
+        self._dirty.add(digest)
+        return metrics
+
+    def save(self):
+        """把新增的度量写回磁盘，写之前合并其他进程已经保存的内容"""
+        for digest in list(self._dirty):
+            table_file = self._table_file(digest)
+            table = self._read_table(table_file)
+            table.update(self._tables[digest])
+            self._tables[digest] = table
+            rows = np.array([[k[0], k[1], v[0][0], v[0][1], v[1][0], v[1][1]] for k, v in table.items()],
+                            dtype=np.int32)
+            try:
+                with atomic_write(table_file) as f:
+                    np.save(f, rows)
+            except OSError as e:
+                print('Could not save glyph metrics %s: %s' % (table_file, e))
+            self._dirty.discard(digest)
+
+
+def render_text_mask(font, text):
+    """
+    用 FreeType 光栅化文字，与 ImageDraw.text 使用同一个灰度蒙版
+    :return: (uint8 蒙版数组 (h, w), 蒙版相对绘制位置的偏移 (x, y))
+    """
+    mask, offset = font.getmask2(text, 'L')
+    # 通过 bytes 转换，只用 PIL 的公开接口；只在缓存未命中时调用，开销远小于光栅化本身
+    w, h = mask.size
+    return np.frombuffer(bytes(mask), dtype=np.uint8).reshape(h, w), tuple(offset)
+
+
+class GlyphAtlas(object):
+    """
+    文字蒙版缓存：(字体路径, 字号, 文字) -> (灰度蒙版, 偏移)，同一段文字在同一字体和字号下只光栅化一次。
+    样本只有 1-2 个字，单字和常见的两字组合很快都会被缓存，按字节预算淘汰最久未使用的蒙版。
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._masks = OrderedDict()
+
+    def __len__(self):
+        return len(self._masks)
+
+    def _put(self, key, entry):
+        self._masks[key] = entry
+        self.nbytes += entry[0].nbytes
+        while self.nbytes > self.max_bytes and self._masks:
+            _, old = self._masks.popitem(last=False)
+            self.nbytes -= old[0].nbytes
+
+    def get(self, font, font_path, size, text):
+        """返回 text 的 (蒙版, 偏移)，见 render_text_mask"""
+        key = (font_path, size, text)
+        entry = self._masks.get(key)
+        if entry is not None:
+            self._masks.move_to_end(key)
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        entry = render_text_mask(font, text)
+        self._put(key, entry)
+        return entry
+
+    def prefill(self, font_pool, fonts_list, chars, sizes, font_coverage=None):
+        """
+        预先光栅化每种字体在 sizes 中每个字号下的所有单字，有覆盖矩阵时跳过字体不支持的字
+        只填单字：垂直文本和带字符间距的水平文本逐字绘制，都能命中；不带间距的两字文本整体绘制（含字距调整），
+        键为整段文字，两字组合太多无法预先填充，第一次使用时再缓存
+        预算不够时只填到预算用完为止
+        """
+        for font_path in fonts_list:
+            font_chars = chars
+            if font_coverage is not None:
+                font_chars = [c for c in chars if font_coverage.supports(font_path, c)]
+            for size in sizes:
+                font = font_pool.get(font_path, size)
+                for c in font_chars:
+                    key = (font_path, size, c)
+                    if key in self._masks:
+                        continue
+                    entry = render_text_mask(font, c)
+                    if self.nbytes + entry[0].nbytes > self.max_bytes:
+                        print('Glyph atlas is full after %d masks' % len(self._masks))
+                        return
+                    self._put(key, entry)
+
+
+def chose_font(fonts, font_sizes, rng=None):
     """选择字体"""
-    f_size = random.choice(font_sizes)  # 不满就取最大字号吧
-    font = random.choice(fonts[f_size])
+    rng = get_rng(rng)
+    f_size = rng.choice(font_sizes)  # 不满就取最大字号吧
+    font = rng.choice(fonts[f_size])
     return font
 
 
-def word_in_font(word, unsupport_chars, font_path):
-    """检查单词中的字符是否在字体中支持"""
-    for c in word:
-        if c in unsupport_chars:
-            print('Retry pick_font(), \'%s\' contains chars \'%s\' not supported by font %s' % (word, c, font_path))  
-            return True
-        else:
-            continue
+def word_in_font(word, font_coverage, font_path):
+    """检查单词中是否有字体不支持的字符，有则返回 True"""
+    return not font_coverage.supports(font_path, word)
 
 
-def get_unsupported_chars(fonts, chars_file):
+class FontCoverage(object):
+    """
+    字体 × 字典字符的布尔覆盖矩阵，matrix[i, j] 表示 fonts[i] 支持 charset[j]。
+    不在字典里的字符不做检查，视为所有字体都支持。
+    """
+
+    def __init__(self, fonts, charset, matrix):
+        self.fonts = list(fonts)
+        self.charset = charset
+        self.matrix = matrix
+        self.font_index = {font_path: i for i, font_path in enumerate(self.fonts)}
+        self.char_index = {c: j for j, c in enumerate(charset)}
+        # 倒排索引：每个字符一行，按位记录支持它的字体
+        self.char_fonts = np.packbits(matrix.T, axis=1)
+
+    def _columns(self, chars):
+        return [self.char_index[c] for c in chars if c in self.char_index]
+
+    def supports(self, font_path, chars):
+        """字体是否支持 chars 中的所有字符"""
+        row = self.matrix[self.font_index[font_path]]
+        for c in chars:
+            j = self.char_index.get(c)
+            if j is not None and not row[j]:
+                return False
+        return True
+
+    def fonts_covering(self, chars):
+        """返回 (n_fonts,) 布尔数组，表示每种字体是否支持 chars 中的所有字符"""
+        cols = self._columns(chars)
+        if not cols:
+            return np.ones(len(self.fonts), dtype=bool)
+        bits = np.bitwise_and.reduce(self.char_fonts[cols], axis=0)
+        return np.unpackbits(bits, count=len(self.fonts)).astype(bool)
+
+
+class FontSampler(object):
+    """
+    按权重抽取字体。
+    text_first 模式下先确定文字，再只从支持文字中所有字符的字体里抽取，
+    不会再因为字体不支持某个字而重试。
+    """
+
+    def __init__(self, fonts, font_coverage=None, weights=None, text_first=False):
+        """
+        :param weights: dict，键为字体文件名（如 msyh.ttc），未列出的字体权重为 1
+        """
+        self.fonts = list(fonts)
+        self.font_coverage = font_coverage
+        self.text_first = text_first and font_coverage is not None
+        weights = weights or {}
+        self.weights = np.array([float(weights.get(os.path.basename(f), 1.0)) for f in self.fonts])
+        self._cum_weights = np.cumsum(self.weights)
+
+    def choose(self, chars=None, rng=None):
+        """
+        抽取一种字体，text_first 模式下只考虑支持 chars 的字体
+        :param rng: 随机数生成器，见 rng_utils.SampleRandom
+        :return: 字体路径，没有字体支持 chars 时返回 None
+        """
+        cum_weights = self._cum_weights
+        if self.text_first and chars is not None:
+            cum_weights = np.cumsum(self.weights * self.font_coverage.fonts_covering(chars))
+        total = cum_weights[-1] if len(cum_weights) else 0
+        if total <= 0:
+            return None
+        i = int(np.searchsorted(cum_weights, get_rng(rng).random() * total, side='right'))
+        return self.fonts[min(i, len(self.fonts) - 1)]
+
+
+def get_font_coverage(fonts, chars_file):
     """
-    Get fonts unsupported chars by loads/saves font supported chars from cache file
-    :param fonts:
-    :param chars_file:
-    :return: dict
-        key -> font_path
-        value -> font unsupported chars
+    读取/保存字体覆盖矩阵，所有字体保存在同一个缓存文件中
+    :param fonts: list of font path. e.g ['./data/fonts/msyh.ttc']
+    :param chars_file: arg from parse_args
+    :return: FontCoverage
     """
     charset = load_chars(chars_file)
-    charset = ''.join(charset)
-    fonts_chars = get_fonts_chars(fonts, chars_file)
-    fonts_unsupported_chars = {}
-    for font_path, chars in fonts_chars.items():
-        unsupported_chars = list(filter(lambda x: x not in chars, charset))
-        fonts_unsupported_chars[font_path] = unsupported_chars
-    return fonts_unsupported_chars
+    cache_file = os.path.join(get_cache_dir(), 'coverage_%s.npz' % md5(charset))
+
+    # 缓存中按字体文件的路径、大小和修改时间索引每一行
+    cached = {}
+    if os.path.exists(cache_file):
+        try:
+            data = np.load(cache_file)
+            cached = dict(zip(data['keys'].tolist(), data['matrix']))
+        except (OSError, ValueError, KeyError) as e:
+            print('Could not load font coverage cache %s: %s' % (cache_file, e))
+
+    matrix = np.zeros((len(fonts), len(charset)), dtype=bool)
+    updated = False
+    for i, font_path in enumerate(fonts):
+        key = file_key(font_path)
+        row = cached.get(key)
+        if row is None or len(row) != len(charset):
+            ttf = load_font(font_path)
+            unsupported_chars, _ = check_font_chars(ttf, charset)
+            unsupported = set(unsupported_chars)
+            row = np.array([c not in unsupported for c in charset], dtype=bool)
+            cached[key] = row
+            updated = True
+        matrix[i] = row
+
+    if updated:
+        keys = list(cached)
+        try:
+            with atomic_write(cache_file) as f:
+                np.savez(f, keys=np.array(keys), matrix=np.array([cached[k] for k in keys], dtype=bool))
+        except OSError as e:
+            print('Could not save font coverage cache %s: %s' % (cache_file, e))
+
+    print('Font coverage: %d fonts x %d chars, %d unsupported pairs' % (matrix.shape[0], matrix.shape[1],
+                                                                        matrix.size - matrix.sum()))
+    return FontCoverage(fonts, charset, matrix)
 
 
 def load_chars(filepath):
@@ -73,47 +369,6 @@ def load_chars(filepath):
     return ret
 
 
-def get_fonts_chars(fonts, chars_file):
-    """
-    loads/saves font supported chars from cache file
-    :param fonts: list of font path. e.g ['./data/fonts/msyh.ttc']
-    :param chars_file: arg from parse_args
-    :return: dict
-        key -> font_path
-        value -> font supported chars
-    """
-    out = {}
-
-    cache_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '../', '.caches'))
-    if not os.path.exists(cache_dir):
-        os.makedirs(cache_dir)
-
-    chars = load_chars(chars_file)
-    chars = ''.join(chars)
-
-    for font_path in fonts:
-        string = ''.join([font_path, chars])
-        file_md5 = md5(string)
-
-        cache_file_path = os.path.join(cache_dir, file_md5)
-
-        if not os.path.exists(cache_file_path):
-            ttf = load_font(font_path)
-            _, supported_chars = check_font_chars(ttf, chars)
-            print('Save font(%s) supported chars(%d) to cache' % (font_path, len(supported_chars)))
-
-            with open(cache_file_path, 'wb') as f:
-                pickle.dump(supported_chars, f, pickle.HIGHEST_PROTOCOL)
-        else:
-            with open(cache_file_path, 'rb') as f:
-                supported_chars = pickle.load(f)
-            print('Load font(%s) supported chars(%d) from cache' % (font_path, len(supported_chars)))
-
-        out[font_path] = supported_chars
-
-    return out
-
-
 def load_font(font_path):
     """
     Read ttc, ttf, otf font file, return a TTFont object
@@ -164,6 +419,3 @@ def check_font_chars(ttf, charset):
     ttf.close()
     return unsupported_chars, supported_chars
 
-
-# Import random for chose_font function
-import random
@@ -3,26 +3,119 @@
 Image processing utilities for OCR image generation
 Contains functions for horizontal and vertical text image generation
 """
-import cv2
 import numpy as np
-import random
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageFont
 
-from color_utils import get_bestcolor, check_color_contrast
-from font_utils import word_in_font
+from color_utils import get_bestcolor, check_color_contrast, get_background_average_color
+from font_utils import word_in_font, render_text_mask
 from text_generator import get_chars
+from background_store import Background, load_background
+from sample_organizer import get_text_direction
+from profiler import tic, toc, count
+from rng_utils import get_rng
 
 
-def get_horizontal_text_picture(image_file, color_lib, char_lines, fonts_list, font_unsupport_chars, cf):
-    """获得水平文本图片"""
+def get_background(image_file, bg_cache=None):
+    """获得背景图片，有缓存时从缓存中取已解码的图片及其积分图"""
+    if bg_cache is not None:
+        return bg_cache.get(image_file)
+    return Background(load_background(image_file))
+
+
+def get_font(font_path, font_size, font_pool=None):
+    """获得字体，有字体池时从字体池中取"""
+    if font_pool is not None:
+        return font_pool.get(font_path, font_size)
+    return ImageFont.truetype(font_path, font_size)
+
+
+def get_char_metrics(font, font_path, font_size, c, glyph_metrics=None):
+    """获得单个字符的大小和偏移，有字形度量表时查表"""
+    if glyph_metrics is not None:
+        return glyph_metrics.get(font, font_path, font_size, c)
+    return font.getsize(c), font.getoffset(c)
+
+
+def get_text_mask(font, font_path, font_size, text, glyph_atlas=None):
+    """获得文字的灰度蒙版和偏移，有蒙版缓存时从缓存中取"""
+    if glyph_atlas is not None:
+        return glyph_atlas.get(font, font_path, font_size, text)
+    return render_text_mask(font, text)
+
+
+def blend_mask(canvas, mask, x, y, color):
+    """
+    把灰度蒙版 mask 以颜色 color 混合到 uint8 RGB 数组 canvas 的 (x, y) 处，超出 canvas 的部分被裁掉
+    与 PIL 绘制文字的公式相同：out = (dst * (255 - a) + color * a) / 255，四舍五入，中间结果不超过 uint16
+    """
+    h, w = mask.shape
+    x1, y1 = max(x, 0), max(y, 0)
+    x2, y2 = min(x + w, canvas.shape[1]), min(y + h, canvas.shape[0])
+    if x1 >= x2 or y1 >= y2:
+        return
+    a = mask[y1 - y:y2 - y, x1 - x:x2 - x, None].astype(np.uint16)
+    dst = canvas[y1:y2, x1:x2]
+    t = dst * (255 - a)
+    t += np.asarray(color, dtype=np.uint16) * a
+    t += 128
+    t += t >> 8
+    t >>= 8
+    dst[...] = t
+
+
+def draw_text(canvas, xy, text, color, font, font_path, font_size, glyph_atlas=None):
+    """在 uint8 RGB 数组上绘制文字，结果与 ImageDraw.Draw(img).text(xy, text, color, font=font) 相同"""
+    mask, offset = get_text_mask(font, font_path, font_size, text, glyph_atlas)
+    blend_mask(canvas, mask, xy[0] + offset[0], xy[1] + offset[1], color)
+
+
+def choose_font(chars, fonts_list, font_sampler=None, retry=0, rng=None):
+    """
+    选择字体。有字体采样器时按其权重抽取，text_first 模式下只从支持 chars 的字体中抽取，
+    重试次数用完后不再限制字体必须支持 chars
+    :return: 字体路径，没有字体支持 chars 时返回 None
+    """
+    if font_sampler is None:
+        return get_rng(rng).choice(fonts_list)
+    return font_sampler.choose(chars if retry < 30 else None, rng)
+
+
+def make_render_info(font_path, font_size, text_color, bg_color, bg_lab_std, crop_box, is_vertical):
+    """
+    渲染时已知的样本信息，保存样本时直接用来分类，不需要再分析图片
+    :param bg_color: 裁剪区域背景的平均颜色
+    :param bg_lab_std: 裁剪区域背景在 Lab 空间的标准差
+    :param crop_box: 裁剪区域在背景图中的位置 (x1, y1, x2, y2)，垂直文本为旋转前的位置
+    """
+    return {
+        'font_path': font_path,
+        'font_size': font_size,
+        'text_color': tuple(int(c) for c in text_color),
+        'bg_color': tuple(int(c) for c in bg_color),
+        'bg_lab_std': float(bg_lab_std),
+        'crop_box': tuple(int(c) for c in crop_box),
+        'direction': get_text_direction(is_vertical)
+    }
+
+
+def get_horizontal_text_picture(image_file, color_lib, char_lines, fonts_list, font_coverage, cf,
+                                bg_cache=None, font_pool=None, glyph_metrics=None, font_sampler=None, rng=None,
+                                glyph_atlas=None):
+    """
+    获得水平文本图片
+    :param rng: 样本的随机数生成器（rng_utils.SampleRandom），所有随机选择都从它取
+    :param glyph_atlas: 文字蒙版缓存（font_utils.GlyphAtlas），为 None 时每次重新光栅化
+    :return: (裁剪后的 uint8 RGB 数组, 文字, 字体路径, render_info)，render_info 见 make_render_info
+    """
+    rng = get_rng(rng)
     retry = 0
-    img = Image.open(image_file)
-    if img.mode != 'RGB':
-        img = img.convert('RGB')
-    w, h = img.size
+    t = tic()
+    bg = get_background(image_file, bg_cache)
+    w, h = bg.size
+    t = toc('background_load', t)
     
     # 随机加入空格
-    rd = random.random()
+    rd = rng.random()
     if rd < 0.3: 
         while True:              
             width = 0
@@ -31,19 +124,23 @@ def get_horizontal_text_picture(image_file, color_lib, char_lines, fonts_list, f
             y_offset = 10 ** 5    
             
             # 随机获得不定长的文字
-            chars = get_chars(char_lines)
+            chars = get_chars(char_lines, rng)
 
             # 随机选择一种字体
-            font_path = random.choice(fonts_list)
-            font_size = random.randint(cf.font_min_size, cf.font_max_size)
+            font_path = choose_font(chars, fonts_list, font_sampler, retry, rng)
+            if font_path is None:  # 没有字体支持这段文字，重新选择文字
+                retry += 1
+                count('retry_no_font')
+                continue
+            font_size = rng.randint(cf.font_min_size, cf.font_max_size)
+            t = toc('choose_text_font', t)
             
             # 获得字体，及其大小
-            font = ImageFont.truetype(font_path, font_size) 
-            # 不支持的字体文字，按照字体路径在该字典里索引即可        
-            unsupport_chars = font_unsupport_chars[font_path]   
+            font = get_font(font_path, font_size, font_pool)
+            t = toc('font_load', t)
                                       
             for c in chars:
-                size = font.getsize(c)
+                size, c_offset = get_char_metrics(font, font_path, font_size, c, glyph_metrics)
                 chars_size.append(size)
                 width += size[0]
                 
@@ -53,11 +150,10 @@ def get_horizontal_text_picture(image_file, color_lib, char_lines, fonts_list, f
     
                 # Min chars y offset as word y offset
                 # Assume only y offset
-                c_offset = font.getoffset(c)
                 if c_offset[1] < y_offset:
                     y_offset = c_offset[1]    
                     
-            char_space_width = int(height * np.random.uniform(-0.1, 0.3))
+            char_space_width = int(height * rng.np.uniform(-0.1, 0.3))
     
             width += (char_space_width * (len(chars) - 1))            
             
@@ -65,8 +161,8 @@ def get_horizontal_text_picture(image_file, color_lib, char_lines, fonts_list, f
             
             if f_w < w:
                 # 完美分割时应该取的
-                x1 = random.randint(0, w - f_w)
-                y1 = random.randint(0, h - f_h)
+                x1 = rng.randint(0, w - f_w)
+                y1 = rng.randint(0, h - f_h)
                 x2 = x1 + f_w
                 y2 = y1 + f_h
                 
@@ -74,13 +170,13 @@ def get_horizontal_text_picture(image_file, color_lib, char_lines, fonts_list, f
                 if cf.random_offset:
                     print('cf.random_offset', cf.random_offset)
                     # 随机加一点偏移，且随机偏移的概率占30%                
-                    rd = random.random()                    
+                    rd = rng.random()                    
                     if rd < 0.3:  # 设定偏移的概率
                         # 分支1：带字符间距的水平文本，需要更多空间适应字符间距变化
-                        crop_y1 = y1 - random.random() / 12 * f_h
-                        crop_x1 = x1 - random.random() / 8 * f_h
-                        crop_y2 = y2 + random.random() / 12 * f_h
-                        crop_x2 = x2 + random.random() / 8 * f_h
+                        crop_y1 = y1 - rng.random() / 12 * f_h
+                        crop_x1 = x1 - rng.random() / 8 * f_h
+                        crop_y2 = y2 + rng.random() / 12 * f_h
+                        crop_x2 = x2 + rng.random() / 8 * f_h
                         crop_y1 = int(max(0, crop_y1))
                         crop_x1 = int(max(0, crop_x1))
                         crop_y2 = int(min(h, crop_y2))
@@ -96,24 +192,36 @@ def get_horizontal_text_picture(image_file, color_lib, char_lines, fonts_list, f
                     crop_y2 = y2
                     crop_x2 = x2                
                 
-                crop_img = img.crop((crop_x1, crop_y1, crop_x2, crop_y2))
-                crop_lab = cv2.cvtColor(np.asarray(crop_img), cv2.COLOR_RGB2Lab)
-           
-                all_in_fonts = word_in_font(chars, unsupport_chars, font_path)
-                if (np.linalg.norm(np.reshape(np.asarray(crop_lab), (-1, 3)).std(axis=0)) > 55 or all_in_fonts) and retry < 30:  # 颜色标准差阈值，颜色太丰富就不要了
-                    retry = retry + 1                               
+                t = toc('layout', t)
+                all_in_fonts = word_in_font(chars, font_coverage, font_path)
+                # 用积分图直接算出裁剪区域的 Lab 标准差，被拒绝的候选区域不需要裁剪
+                lab_std = bg.lab_std(crop_x1, crop_y1, crop_x2, crop_y2)
+                rejected = (all_in_fonts or lab_std > 55) and retry < 30  # 颜色标准差阈值，颜色太丰富就不要了
+                t = toc('lab_reject', t)
+                if rejected:
+                    retry = retry + 1
+                    count('retry_rejected')
                     continue
+                crop_img = bg.rgb[crop_y1:crop_y2, crop_x1:crop_x2]
+                crop_lab = bg.lab[crop_y1:crop_y2, crop_x1:crop_x2]
+                bg_color = get_background_average_color(crop_img)
                 if not cf.customize_color:
-                    best_color = get_bestcolor(color_lib, crop_lab)
+                    best_color = get_bestcolor(color_lib, crop_lab, cf.color_method, bg_color=bg_color, min_contrast=2.5,
+                                               rng=rng)
                 else:    
-                    r = random.choice([7, 9, 11, 14, 13, 15, 17, 20, 22, 50, 100])
-                    g = random.choice([8, 10, 12, 14, 21, 22, 24, 23, 50, 100])
-                    b = random.choice([6, 8, 9, 10, 11, 30, 21, 34, 56, 100])
+                    r = rng.choice([7, 9, 11, 14, 13, 15, 17, 20, 22, 50, 100])
+                    g = rng.choice([8, 10, 12, 14, 21, 22, 24, 23, 50, 100])
+                    b = rng.choice([6, 8, 9, 10, 11, 30, 21, 34, 56, 100])
                     best_color = (r, g, b)
                 
+                t = toc('color_pick', t)
+
                 # 检查颜色对比度，如果对比度不足则重新生成
-                if not check_color_contrast(best_color, crop_img, min_contrast=2.5):
+                low_contrast = not check_color_contrast(best_color, crop_img, min_contrast=2.5, bg_color=bg_color)
+                t = toc('contrast_check', t)
+                if low_contrast:
                     retry += 1
+                    count('retry_contrast')
                     if retry < 30:
                         continue
                 
@@ -121,45 +229,53 @@ def get_horizontal_text_picture(image_file, color_lib, char_lines, fonts_list, f
             else:
                 pass  
                 
-        draw = ImageDraw.Draw(img)    
+        # 只复制裁剪区域并在上面绘制，文字位置平移到裁剪区域的坐标系，超出裁剪区域的部分被裁掉
+        canvas = np.array(bg.rgb[crop_y1:crop_y2, crop_x1:crop_x2])
+        x, y = x1 - crop_x1, y1 - crop_y1
         for i, c in enumerate(chars):
-            draw.text((x1, y1), c, best_color, font=font)
-            x1 += (chars_size[i][0] + char_space_width)    
-        crop_img = img.crop((crop_x1, crop_y1, crop_x2, crop_y2))
-        return crop_img, chars, font_path 
+            draw_text(canvas, (x, y), c, best_color, font, font_path, font_size, glyph_atlas)
+            x += (chars_size[i][0] + char_space_width)
+        toc('draw', t)
+        render_info = make_render_info(font_path, font_size, best_color, bg_color, lab_std,
+                                       (crop_x1, crop_y1, crop_x2, crop_y2), False)
+        return canvas, chars, font_path, render_info
    
     else:
         while True:            
             # 随机获得不定长的文字
-            chars = get_chars(char_lines)
+            chars = get_chars(char_lines, rng)
         
             # 随机选择一种字体
-            font_path = random.choice(fonts_list)
-            font_size = random.randint(cf.font_min_size, cf.font_max_size)
+            font_path = choose_font(chars, fonts_list, font_sampler, retry, rng)
+            if font_path is None:  # 没有字体支持这段文字，重新选择文字
+                retry += 1
+                count('retry_no_font')
+                continue
+            font_size = rng.randint(cf.font_min_size, cf.font_max_size)
+            t = toc('choose_text_font', t)
             
             # 获得字体，及其大小
-            font = ImageFont.truetype(font_path, font_size) 
-            # 不支持的字体文字，按照字体路径在该字典里索引即可    
-            unsupport_chars = font_unsupport_chars[font_path]  
+            font = get_font(font_path, font_size, font_pool)
+            t = toc('font_load', t)
             f_w, f_h = font.getsize(chars)
             
             if f_w < w:
                 # 完美分割时应该取的
-                x1 = random.randint(0, w - f_w)
-                y1 = random.randint(0, h - f_h)
+                x1 = rng.randint(0, w - f_w)
+                y1 = rng.randint(0, h - f_h)
                 x2 = x1 + f_w
                 y2 = y1 + f_h
                                 
                 # 加一点偏移
                 if cf.random_offset:                
                     # 随机加一点偏移，且随机偏移的概率占30%                
-                    rd = random.random()
+                    rd = rng.random()
                     if rd < 0.3:  # 设定偏移的概率
                         # 分支2：整体水平文本，可以更紧凑
-                        crop_y1 = y1 - random.random() / 25 * f_h
-                        crop_x1 = x1 - random.random() / 20 * f_h
-                        crop_y2 = y2 + random.random() / 25 * f_h
-                        crop_x2 = x2 + random.random() / 20 * f_h
+                        crop_y1 = y1 - rng.random() / 25 * f_h
+                        crop_x1 = x1 - rng.random() / 20 * f_h
+                        crop_y2 = y2 + rng.random() / 25 * f_h
+                        crop_x2 = x2 + rng.random() / 20 * f_h
                         crop_y1 = int(max(0, crop_y1))
                         crop_x1 = int(max(0, crop_x1))
                         crop_y2 = int(min(h, crop_y2))
@@ -175,28 +291,40 @@ def get_horizontal_text_picture(image_file, color_lib, char_lines, fonts_list, f
                     crop_y2 = y2
                     crop_x2 = x2    
     
-                crop_img = img.crop((crop_x1, crop_y1, crop_x2, crop_y2))
-                crop_lab = cv2.cvtColor(np.asarray(crop_img), cv2.COLOR_RGB2Lab)
-                
+                t = toc('layout', t)
                 # 判断语料中每个字是否在字体文件中
-                all_in_fonts = word_in_font(chars, unsupport_chars, font_path)
-                if (np.linalg.norm(np.reshape(np.asarray(crop_lab), (-1, 3)).std(axis=0)) > 55 or all_in_fonts) and retry < 30:  # 颜色标准差阈值，颜色太丰富就不要了,单词不在字体文件中不要
-                    retry = retry + 1                               
+                all_in_fonts = word_in_font(chars, font_coverage, font_path)
+                # 用积分图直接算出裁剪区域的 Lab 标准差，被拒绝的候选区域不需要裁剪
+                lab_std = bg.lab_std(crop_x1, crop_y1, crop_x2, crop_y2)
+                rejected = (all_in_fonts or lab_std > 55) and retry < 30  # 颜色标准差阈值，颜色太丰富就不要了,单词不在字体文件中不要
+                t = toc('lab_reject', t)
+                if rejected:
+                    retry = retry + 1
+                    count('retry_rejected')
                     print('retry', retry)
                     continue
+                crop_img = bg.rgb[crop_y1:crop_y2, crop_x1:crop_x2]
+                crop_lab = bg.lab[crop_y1:crop_y2, crop_x1:crop_x2]
+                bg_color = get_background_average_color(crop_img)
                 if not cf.customize_color:    
-                    best_color = get_bestcolor(color_lib, crop_lab)
+                    best_color = get_bestcolor(color_lib, crop_lab, cf.color_method, bg_color=bg_color, min_contrast=2.5,
+                                               rng=rng)
                 
                 # 可以自定义字体颜色
                 else:
-                    r = random.choice([7, 9, 11, 14, 13, 15, 17, 20, 22, 50, 100])
-                    g = random.choice([8, 10, 12, 14, 21, 22, 24, 23, 50, 100])
-                    b = random.choice([6, 8, 9, 10, 11, 30, 21, 34, 56, 100])
+                    r = rng.choice([7, 9, 11, 14, 13, 15, 17, 20, 22, 50, 100])
+                    g = rng.choice([8, 10, 12, 14, 21, 22, 24, 23, 50, 100])
+                    b = rng.choice([6, 8, 9, 10, 11, 30, 21, 34, 56, 100])
                     best_color = (r, g, b)
                 
+                t = toc('color_pick', t)
+
                 # 检查颜色对比度，如果对比度不足则重新生成
-                if not check_color_contrast(best_color, crop_img, min_contrast=2.5):
+                low_contrast = not check_color_contrast(best_color, crop_img, min_contrast=2.5, bg_color=bg_color)
+                t = toc('contrast_check', t)
+                if low_contrast:
                     retry += 1
+                    count('retry_contrast')
                     if retry < 30:
                         continue
                 
@@ -204,57 +332,72 @@ def get_horizontal_text_picture(image_file, color_lib, char_lines, fonts_list, f
             else:
                 pass
     
-        draw = ImageDraw.Draw(img)
-        draw.text((x1, y1), chars, best_color, font=font)
-        crop_img = img.crop((crop_x1, crop_y1, crop_x2, crop_y2))
-        return crop_img, chars, font_path
+        # 只复制裁剪区域并在上面绘制，文字位置平移到裁剪区域的坐标系
+        canvas = np.array(bg.rgb[crop_y1:crop_y2, crop_x1:crop_x2])
+        draw_text(canvas, (x1 - crop_x1, y1 - crop_y1), chars, best_color, font, font_path, font_size, glyph_atlas)
+        toc('draw', t)
+        render_info = make_render_info(font_path, font_size, best_color, bg_color, lab_std,
+                                       (crop_x1, crop_y1, crop_x2, crop_y2), False)
+        return canvas, chars, font_path, render_info
 
 
-def get_vertical_text_picture(image_file, color_lib, char_lines, fonts_list, font_unsupport_chars, cf):
-    """获得垂直文本图片"""
-    img = Image.open(image_file)
-    if img.mode != 'RGB':
-        img = img.convert('RGB')
-    w, h = img.size
+def get_vertical_text_picture(image_file, color_lib, char_lines, fonts_list, font_coverage, cf,
+                              bg_cache=None, font_pool=None, glyph_metrics=None, font_sampler=None, rng=None,
+                                glyph_atlas=None):
+    """
+    获得垂直文本图片
+    :param rng: 样本的随机数生成器（rng_utils.SampleRandom），所有随机选择都从它取
+    :param glyph_atlas: 文字蒙版缓存（font_utils.GlyphAtlas），为 None 时每次重新光栅化
+    :return: (逆时针旋转 90 度后的 uint8 RGB 数组, 文字, 字体路径, render_info)，render_info 见 make_render_info
+    """
+    rng = get_rng(rng)
+    t = tic()
+    bg = get_background(image_file, bg_cache)
+    w, h = bg.size
+    t = toc('background_load', t)
     retry = 0
     while True:
                 
         # 随机获得不定长的文字
-        chars = get_chars(char_lines)
+        chars = get_chars(char_lines, rng)
         
         # 随机选择一种字体
-        font_path = random.choice(fonts_list)
-        font_size = random.randint(cf.font_min_size, cf.font_max_size)
+        font_path = choose_font(chars, fonts_list, font_sampler, retry, rng)
+        if font_path is None:  # 没有字体支持这段文字，重新选择文字
+            retry += 1
+            count('retry_no_font')
+            continue
+        font_size = rng.randint(cf.font_min_size, cf.font_max_size)
+        t = toc('choose_text_font', t)
         
         # 获得字体，及其大小
-        font = ImageFont.truetype(font_path, font_size) 
-        # 不支持的字体文字，按照字体路径在该字典里索引即可    
-        unsupport_chars = font_unsupport_chars[font_path]  
+        font = get_font(font_path, font_size, font_pool)
+        t = toc('font_load', t)
         
         ch_w = []
         ch_h = []
         for ch in chars:
-            wt, ht = font.getsize(ch)
+            (wt, ht), _ = get_char_metrics(font, font_path, font_size, ch, glyph_metrics)
             ch_w.append(wt)
             ch_h.append(ht)
         f_w = max(ch_w)
         f_h = sum(ch_h)
         # 完美分割时应该取的,也即文本位置
         if h > f_h:
-            x1 = random.randint(0, w - f_w)
-            y1 = random.randint(0, h - f_h)
+            x1 = rng.randint(0, w - f_w)
+            y1 = rng.randint(0, h - f_h)
             x2 = x1 + f_w
             y2 = y1 + f_h            
                       
             if cf.random_offset:                
                 # 随机加一点偏移，且随机偏移的概率占30%                
-                rd = random.random()
+                rd = rng.random()
                 if rd < 0.3:  # 设定偏移的概率
                     # 分支3：垂直文本，垂直方向需要更多空间，水平方向可以紧凑
-                    crop_y1 = y1 - random.random() / 15 * f_h
-                    crop_x1 = x1 - random.random() / 25 * f_h
-                    crop_y2 = y2 + random.random() / 15 * f_h
-                    crop_x2 = x2 + random.random() / 25 * f_h
+                    crop_y1 = y1 - rng.random() / 15 * f_h
+                    crop_x1 = x1 - rng.random() / 25 * f_h
+                    crop_y2 = y2 + rng.random() / 15 * f_h
+                    crop_x2 = x2 + rng.random() / 25 * f_h
                     crop_y1 = int(max(0, crop_y1))
                     crop_x1 = int(max(0, crop_x1))
                     crop_y2 = int(min(h, crop_y2))
@@ -270,24 +413,36 @@ def get_vertical_text_picture(image_file, color_lib, char_lines, fonts_list, fon
                 crop_y2 = y2
                 crop_x2 = x2               
                                                
-            crop_img = img.crop((crop_x1, crop_y1, crop_x2, crop_y2))
-            crop_lab = cv2.cvtColor(np.asarray(crop_img), cv2.COLOR_RGB2Lab)
-            
-            all_in_fonts = word_in_font(chars, unsupport_chars, font_path)
-            if (np.linalg.norm(np.reshape(np.asarray(crop_lab), (-1, 3)).std(axis=0)) > 55 or all_in_fonts) and retry < 30:  # 颜色标准差阈值，颜色太丰富就不要了
+            t = toc('layout', t)
+            all_in_fonts = word_in_font(chars, font_coverage, font_path)
+            # 用积分图直接算出裁剪区域的 Lab 标准差，被拒绝的候选区域不需要裁剪
+            lab_std = bg.lab_std(crop_x1, crop_y1, crop_x2, crop_y2)
+            rejected = (all_in_fonts or lab_std > 55) and retry < 30  # 颜色标准差阈值，颜色太丰富就不要了
+            t = toc('lab_reject', t)
+            if rejected:
                 retry = retry + 1
+                count('retry_rejected')
                 continue
+            crop_img = bg.rgb[crop_y1:crop_y2, crop_x1:crop_x2]
+            crop_lab = bg.lab[crop_y1:crop_y2, crop_x1:crop_x2]
+            bg_color = get_background_average_color(crop_img)
             if not cf.customize_color:
-                best_color = get_bestcolor(color_lib, crop_lab)
+                best_color = get_bestcolor(color_lib, crop_lab, cf.color_method, bg_color=bg_color, min_contrast=2.5,
+                                           rng=rng)
             else:
-                r = random.choice([7, 9, 11, 14, 13, 15, 17, 20, 22, 50, 100])
-                g = random.choice([8, 10, 12, 14, 21, 22, 24, 23, 50, 100])
-                b = random.choice([6, 8, 9, 10, 11, 30, 21, 34, 56, 100])
+                r = rng.choice([7, 9, 11, 14, 13, 15, 17, 20, 22, 50, 100])
+                g = rng.choice([8, 10, 12, 14, 21, 22, 24, 23, 50, 100])
+                b = rng.choice([6, 8, 9, 10, 11, 30, 21, 34, 56, 100])
                 best_color = (r, g, b)
             
+            t = toc('color_pick', t)
+
             # 检查颜色对比度，如果对比度不足则重新生成
-            if not check_color_contrast(best_color, crop_img, min_contrast=2.5):
+            low_contrast = not check_color_contrast(best_color, crop_img, min_contrast=2.5, bg_color=bg_color)
+            t = toc('contrast_check', t)
+            if low_contrast:
                 retry += 1
+                count('retry_contrast')
                 if retry < 30:
                     continue
             
@@ -295,13 +450,18 @@ def get_vertical_text_picture(image_file, color_lib, char_lines, fonts_list, fon
         else:
             pass
 
-    draw = ImageDraw.Draw(img)
+    # 只复制裁剪区域并在上面绘制，文字位置平移到裁剪区域的坐标系
+    canvas = np.array(bg.rgb[crop_y1:crop_y2, crop_x1:crop_x2])
+    x, y = x1 - crop_x1, y1 - crop_y1
     i = 0
     for ch in chars:
-        draw.text((x1, y1), ch, best_color, font=font)
-        y1 = y1 + ch_h[i]
+        draw_text(canvas, (x, y), ch, best_color, font, font_path, font_size, glyph_atlas)
+        y = y + ch_h[i]
         i = i + 1
 
-    crop_img = img.crop((crop_x1, crop_y1, crop_x2, crop_y2))
-    crop_img = crop_img.transpose(Image.ROTATE_90)
-    return crop_img, chars, font_path
+    # 与 PIL 的 transpose(Image.ROTATE_90) 相同，逆时针旋转 90 度，复制成连续数组供后续原地增强
+    canvas = np.ascontiguousarray(np.rot90(canvas))
+    toc('draw', t)
+    render_info = make_render_info(font_path, font_size, best_color, bg_color, lab_std,
+                                   (crop_x1, crop_y1, crop_x2, crop_y2), True)
+    return canvas, chars, font_path, render_info
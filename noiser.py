@@ -1,15 +1,136 @@
+from multiprocessing import shared_memory
+
 import numpy as np
 import cv2
 
+from rng_utils import get_rng
+
+
+class NoiseBank(object):
+    """
+    预先生成的噪声场，放在共享内存中，多个进程共用一份。
+    - gauss: 标准正态分布 N(0, 1)，float32
+    - uniform: 均匀分布 U(-1, 1)，float32
+    - sp: 均匀分布的 uint32，取模后作为椒盐噪声的位置
+    每张图片从随机的一个噪声场中取随机位置、随机上下翻转的一块，噪声的分布与每次重新生成时相同，
+    加噪声的开销只与图片大小有关，不再需要调用随机数生成器生成整张图的噪声。
+    """
+
+    KINDS = {'gauss': np.float32, 'uniform': np.float32, 'sp': np.uint32}
+
+    def __init__(self, shape, shms, owner=False):
+        self.shape = tuple(shape)
+        self._shms = shms
+        self.owner = owner
+        self.fields = {kind: np.ndarray(self.shape, dtype=dtype, buffer=shms[kind].buf)
+                       for kind, dtype in self.KINDS.items()}
+
+    @classmethod
+    def create(cls, num_fields=4, size=512, channels=3, seed=None):
+        """在主进程中生成噪声场"""
+        shape = (num_fields, size, size, channels)
+        shms = {kind: shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * np.dtype(dtype).itemsize)
+                for kind, dtype in cls.KINDS.items()}
+        bank = cls(shape, shms, owner=True)
+        rng = np.random.default_rng(seed)
+        rng.standard_normal(out=bank.fields['gauss'], dtype=np.float32)
+        uniform = bank.fields['uniform']
+        rng.random(out=uniform, dtype=np.float32)
+        uniform *= 2
+        uniform -= 1
+        bank.fields['sp'][...] = rng.integers(0, 1 << 32, size=shape, dtype=np.uint32)
+        return bank
+
+    @property
+    def spec(self):
+        """传给子进程的描述，子进程用 attach() 映射同一块共享内存"""
+        return {'shape': self.shape, 'names': {kind: shm.name for kind, shm in self._shms.items()}}
+
+    @classmethod
+    def attach(cls, spec):
+        # 进程池的子进程与主进程共用同一个 resource_tracker，共享内存由主进程 close() 时释放
+        shms = {kind: shared_memory.SharedMemory(name=name) for kind, name in spec['names'].items()}
+        return cls(spec['shape'], shms)
+
+    def fits(self, shape):
+        """图片能否从噪声场中取出"""
+        return (len(shape) >= 2 and shape[0] <= self.shape[1] and shape[1] <= self.shape[2]
+                and (shape[2] if len(shape) == 3 else 1) <= self.shape[3])
+
+    def take(self, kind, shape, rng=None):
+        """
+        从随机噪声场的随机位置取出 shape 大小的一块，随机上下翻转，返回视图。
+        不做左右翻转：左右翻转后每行内的步长为负，逐元素运算比连续的行慢近十倍
+        """
+        rng = get_rng(rng).np
+        h, w = shape[:2]
+        _, size_h, size_w, _ = self.shape
+        k = rng.integers(self.shape[0])
+        y = rng.integers(size_h - h + 1)
+        x = rng.integers(size_w - w + 1)
+        patch = self.fields[kind][k, y:y + h, x:x + w]
+        if rng.integers(2):
+            patch = patch[::-1]
+        return patch if len(shape) == 3 else patch[..., 0]
+
+    def take_indices(self, n, size, rng=None):
+        """
+        从 sp 噪声场的随机位置取出 n 个 [0, size) 内的随机下标（展平后的下标），开销只与 n 有关
+        size 远小于 2 ** 32，取模带来的偏差可以忽略
+        """
+        rng = get_rng(rng).np
+        flat = self.fields['sp'].reshape(-1)
+        if n > flat.size:
+            return rng.integers(0, size, n)
+        offset = rng.integers(flat.size - n + 1)
+        return flat[offset:offset + n] % size
+
+    def close(self):
+        self.fields = {}
+        for shm in self._shms.values():
+            shm.close()
+        if self.owner:
+            for shm in self._shms.values():
+                shm.unlink()
+        self._shms = {}
+
 
 # https://stackoverflow.com/questions/22937589/how-to-add-noise-gaussian-salt-and-pepper-etc-to-image-in-python-with-opencv
 class Noiser(object):
-    def __init__(self, cfg):
+    """
+    输入输出都是 uint8 图片，噪声缓冲区（float32）在多次调用间复用，结果饱和到 [0, 255]。
+    各方法的 dst 参数指定输出数组，可以就是 img（原地处理），为 None 时返回新数组。
+    """
+
+    def __init__(self, cfg, bank=None):
+        """
+        :param bank: NoiseBank，不为 None 时 gauss、uniform 和椒盐噪声从预先生成的噪声场中取
+        """
         self.cfg = cfg
+        self.bank = bank
+        self._buffers = {}
+
+    def _from_bank(self, img):
+        return self.bank is not None and self.bank.fits(img.shape)
+
+    def _buffer(self, name, shape, dtype=np.float32):
+        """按名字复用的缓冲区，不够大时扩容"""
+        size = int(np.prod(shape))
+        buf = self._buffers.get(name)
+        if buf is None or buf.size < size or buf.dtype != dtype:
+            buf = self._buffers[name] = np.empty(size, dtype=dtype)
+        return buf[:size].reshape(shape)
+
+    @staticmethod
+    def _as_uint8(img):
+        if img.dtype == np.uint8:
+            return img
+        return np.clip(np.rint(img), 0, 255).astype(np.uint8)
 
-    def apply(self, img):
+    def apply(self, img, dst=None, rng=None):
         """
         :param img:  word image with big background
+        :param rng: 样本的随机数生成器，见 rng_utils.SampleRandom
         """
 
         p = []
@@ -33,62 +154,92 @@ class Noiser(object):
         if len(p) == 0:
             return img
 
-        noise_func = np.random.choice(funcs, p=p)
+        noise_func = funcs[get_rng(rng).np.choice(len(funcs), p=p)]
 
-        return noise_func(img)
+        return noise_func(img, dst=dst, rng=rng)
 
-    def apply_gauss_noise(self, img):
+    def apply_gauss_noise(self, img, dst=None, rng=None):
         """
         Gaussian-distributed additive noise.
         """
+        rng = get_rng(rng)
+        img = self._as_uint8(img)
         mean = 0
-        stddev = np.sqrt(15)
-        gauss_noise = np.zeros(img.shape)
-        cv2.randn(gauss_noise, mean, stddev)
-        out = img + gauss_noise
-
-        return out
-
-    def apply_uniform_noise(self, img):
+        stddev = float(np.sqrt(15))
+        gauss_noise = self._buffer('gauss', img.shape)
+        if self._from_bank(img):
+            np.multiply(self.bank.take('gauss', img.shape, rng), stddev, out=gauss_noise)
+            if mean:
+                gauss_noise += mean
+        else:
+            # cv2.randn 比 numpy 快一倍多，用样本的生成器给 OpenCV 当前线程的随机数播种，结果仍可复现
+            cv2.setRNGSeed(int(rng.np.integers(1 << 31)))
+            # 多通道时均值和标准差要给每个通道都指定，只给一个数时只有第一个通道有噪声
+            channels = img.shape[2] if img.ndim == 3 else 1
+            cv2.randn(gauss_noise, (mean,) * channels, (stddev,) * channels)
+        return cv2.add(img, gauss_noise, dst=dst, dtype=cv2.CV_8U)
+
+    def apply_uniform_noise(self, img, dst=None, rng=None):
         """
         Apply zero-mean uniform noise
         """
-        imshape = img.shape
+        rng = get_rng(rng)
+        img = self._as_uint8(img)
         alpha = 0.05
-        gauss = np.random.uniform(0 - alpha, alpha, imshape)
-        gauss = gauss.reshape(*imshape)
-        out = img + img * gauss
-        return out
-
-    def apply_sp_noise(self, img):
+        scale = self._buffer('uniform', img.shape)
+        if self._from_bank(img):
+            np.multiply(self.bank.take('uniform', img.shape, rng), alpha, out=scale)
+        else:
+            # [0, 1) 变换到 [-alpha, alpha)
+            rng.np.random(out=scale, dtype=np.float32)
+            scale *= 2 * alpha
+            scale -= alpha
+        scale += 1
+        # img + img * u = img * (1 + u)
+        return cv2.multiply(img, scale, dst=dst, dtype=cv2.CV_8U)
+
+    def apply_sp_noise(self, img, dst=None, rng=None):
         """
         Salt and pepper noise. Replaces random pixels with 0 or 255.
         """
+        rng = get_rng(rng)
+        img = self._as_uint8(img)
         s_vs_p = 0.5
-        amount = np.random.uniform(0.004, 0.01)
-        out = np.copy(img)
-        # Salt mode
-        num_salt = np.ceil(amount * img.size * s_vs_p)
-        coords = [np.random.randint(0, i - 1, int(num_salt))
-                  for i in img.shape]
-        out[coords] = 255.
-
-        # Pepper mode
-        num_pepper = np.ceil(amount * img.size * (1. - s_vs_p))
-        coords = [np.random.randint(0, i - 1, int(num_pepper))
-                  for i in img.shape]
-        out[coords] = 0
+        amount = rng.np.uniform(0.004, 0.01)
+        if dst is None:
+            out = np.copy(img)
+        else:
+            out = dst
+            if out is not img:
+                np.copyto(out, img)
+
+        # 盐和椒的位置为展平后的下标，均匀分布在所有像素和通道上
+        num_salt = int(np.ceil(amount * img.size * s_vs_p))
+        num_pepper = int(np.ceil(amount * img.size * (1. - s_vs_p)))
+        if self.bank is not None:
+            # 直接取噪声场中连续的一段随机数，不需要为整张图生成随机数
+            coords = self.bank.take_indices(num_salt + num_pepper, img.size, rng)
+        else:
+            coords = rng.np.integers(0, img.size, num_salt + num_pepper)
+        np.put(out, coords[:num_salt], 255)
+        np.put(out, coords[num_salt:], 0)
         return out
 
-    def apply_poisson_noise(self, img):
+    def apply_poisson_noise(self, img, dst=None, rng=None):
         """
         Poisson-distributed noise generated from the data.
         """
-        vals = len(np.unique(img))
+        rng = get_rng(rng)
+        img = self._as_uint8(img)
+        # uint8 图片最多 256 种取值，用直方图数出不同取值的个数，不需要 np.unique 排序
+        vals = np.count_nonzero(np.bincount(img.ravel(), minlength=256))
         vals = 2 ** np.ceil(np.log2(vals))
 
-        if vals < 0:
-            return img
-
-        noisy = np.random.poisson(img * vals) / float(vals)
-        return noisy
+        # 乘以 2 的幂后 float32 仍能精确表示，除回来也没有舍入误差
+        lam = self._buffer('poisson', img.shape)
+        np.multiply(img, vals, out=lam)
+        # Generator.poisson 没有 out 参数，只有这里会分配一个 int64 数组
+        noisy = rng.np.poisson(lam)
+        np.multiply(noisy, 1 / vals, out=lam, casting='unsafe')
+        # 四舍五入并饱和到 [0, 255]
+        return cv2.convertScaleAbs(lam, dst=dst)
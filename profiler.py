@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Profiling utilities for OCR image generation
+Contains opt-in per-stage timers and retry counters reported as JSON with --profile
+"""
+import json
+import math
+import time
+import threading
+
+from cache_utils import atomic_write
+
+# 耗时按对数分桶统计：1us ~ 1000s，每个数量级 10 个桶，内存固定，多进程的结果可以直接相加
+MIN_EXP = -6
+MAX_EXP = 3
+BUCKETS_PER_DECADE = 10
+NUM_BUCKETS = (MAX_EXP - MIN_EXP) * BUCKETS_PER_DECADE + 2
+
+
+def _bucket(seconds):
+    if seconds <= 10 ** MIN_EXP:
+        return 0
+    i = int((math.log10(seconds) - MIN_EXP) * BUCKETS_PER_DECADE) + 1
+    return min(i, NUM_BUCKETS - 1)
+
+
+def _bucket_upper(i):
+    """第 i 个桶的上界（秒）"""
+    return 10 ** (MIN_EXP + i / BUCKETS_PER_DECADE)
+
+
+class Profiler(object):
+    """
+    各阶段耗时和计数。未启用时 tic() 返回 0，toc() 直接返回，几乎没有开销。
+    渲染线程和后台写入线程都会记录，记录时加锁。
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # name -> [count, total, max, buckets]
+            self.stages = {}
+            self.counters = {}
+
+    def tic(self):
+        """开始计时"""
+        return time.perf_counter() if self.enabled else 0
+
+    def toc(self, name, t):
+        """
+        记录从 t 到现在的耗时，返回当前时间，可以接着作为下一个阶段的开始
+        用法：t = tic(); ...; t = toc('stage_a', t); ...; t = toc('stage_b', t)
+        """
+        if not self.enabled:
+            return 0
+        now = time.perf_counter()
+        self.add(name, now - t)
+        return now
+
+    def add(self, name, seconds):
+        with self._lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = [0, 0., 0., [0] * NUM_BUCKETS]
+            stage[0] += 1
+            stage[1] += seconds
+            stage[2] = max(stage[2], seconds)
+            stage[3][_bucket(seconds)] += 1
+
+    def count(self, name, n=1):
+        """计数，如各种原因的重试次数"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def snapshot(self, reset=False):
+        """原始数据，子进程用它把结果传回主进程"""
+        with self._lock:
+            data = {
+                'stages': {name: [s[0], s[1], s[2], list(s[3])] for name, s in self.stages.items()},
+                'counters': dict(self.counters)
+            }
+        if reset:
+            self.reset()
+        return data
+
+    def merge(self, data):
+        """合并子进程的 snapshot()"""
+        with self._lock:
+            for name, (count, total, max_t, buckets) in data['stages'].items():
+                stage = self.stages.get(name)
+                if stage is None:
+                    stage = self.stages[name] = [0, 0., 0., [0] * NUM_BUCKETS]
+                stage[0] += count
+                stage[1] += total
+                stage[2] = max(stage[2], max_t)
+                stage[3] = [a + b for a, b in zip(stage[3], buckets)]
+            for name, n in data['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    @staticmethod
+    def _percentile(count, buckets, q):
+        """由分桶估算分位数，误差在一个桶以内（约 25%）"""
+        target = q * count
+        acc = 0
+        for i, n in enumerate(buckets):
+            acc += n
+            if acc >= target:
+                return _bucket_upper(i)
+        return _bucket_upper(len(buckets) - 1)
+
+    def report(self):
+        """各阶段的次数、总耗时、平均、p50、p95 和最大耗时（秒），按总耗时从大到小排列"""
+        data = self.snapshot()
+        stages = {}
+        for name, (count, total, max_t, buckets) in sorted(data['stages'].items(), key=lambda x: -x[1][1]):
+            stages[name] = {
+                'count': count,
+                'total': round(total, 6),
+                'mean': round(total / count if count else 0, 7),
+                'p50': round(min(self._percentile(count, buckets, 0.5), max_t), 7),
+                'p95': round(min(self._percentile(count, buckets, 0.95), max_t), 7),
+                'max': round(max_t, 7)
+            }
+        return {'stages': stages, 'counters': data['counters']}
+
+
+# 每个进程一个实例
+PROFILER = Profiler()
+tic = PROFILER.tic
+toc = PROFILER.toc
+count = PROFILER.count
+
+
+class ProfileReport(object):
+    """把 PROFILER 的统计结果定期写入 JSON 文件"""
+
+    def __init__(self, path, interval=60):
+        self.path = path
+        self.interval = interval
+        self.t0 = time.time()
+        self._last = self.t0
+
+    def update(self, **extra):
+        """距上次写入超过 interval 秒时写一次"""
+        if time.time() - self._last >= self.interval:
+            self.write(**extra)
+
+    def write(self, **extra):
+        """先写临时文件再改名"""
+        self._last = time.time()
+        data = dict(extra, elapsed=self._last - self.t0, **PROFILER.report())
+        try:
+            with atomic_write(self.path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, indent=2)
+        except OSError as e:
+            print(f'Could not write profile report {self.path}: {e}')
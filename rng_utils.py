@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+Random number utilities for OCR image generation
+Contains the per-sample random generator derived from (run seed, sample index)
+"""
+import random
+
+import numpy as np
+
+
+class SampleRandom(random.Random):
+    """
+    random.Random 的子类，另带一个 numpy Generator（.np），两者由同一个种子派生。
+    每个样本用 (运行种子, 样本编号) 创建一个，样本中所有随机选择都从它取，
+    结果与生成顺序、进程数无关，任意一个样本都可以单独重新生成。
+    """
+
+    def seed(self, a=None, version=2):
+        """
+        :param a: 整数、整数元组（如 (运行种子, 样本编号)），或 None（从系统熵源取种子）
+        """
+        if isinstance(a, (tuple, list)):
+            seq = np.random.SeedSequence([int(x) for x in a])
+        else:
+            seq = np.random.SeedSequence(a)
+        state = seq.generate_state(4)
+        super(SampleRandom, self).seed(int.from_bytes(state.tobytes(), 'little'))
+        self.np = np.random.Generator(np.random.PCG64(seq))
+
+
+def sample_rng(seed, index):
+    """编号为 index 的样本的随机数生成器"""
+    return SampleRandom((seed, index))
+
+
+def new_run_seed():
+    """没有指定 --seed 时，从系统熵源取一个运行种子，保存在断点文件中"""
+    return int(np.random.SeedSequence().entropy)
+
+
+# 调用方没有传入生成器时使用的进程级生成器
+DEFAULT_RNG = SampleRandom()
+
+
+def get_rng(rng=None):
+    return rng if rng is not None else DEFAULT_RNG
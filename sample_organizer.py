@@ -8,6 +8,9 @@ import cv2
 import numpy as np
 from PIL import Image
 
+from color_utils import relative_luminance
+from profiler import tic, toc
+
 
 def get_font_name(font_path):
     """从字体路径提取字体名称"""
@@ -45,6 +48,15 @@ def analyze_text_color(image):
         return 'white_on_black'
 
 
+def classify_text_color(text_color, bg_color):
+    """由渲染时的文字颜色和背景平均颜色判断，文字比背景暗则为白底黑字
+    Returns: 'black_on_white' 或 'white_on_black'
+    """
+    if relative_luminance(text_color) < relative_luminance(bg_color):
+        return 'black_on_white'
+    return 'white_on_black'
+
+
 def get_text_direction(is_vertical, rotation=0):
     """确定文本方向
     Args:
@@ -68,13 +80,20 @@ def create_sample_directory(output_dir, font_name, direction, color_type):
     return sample_dir
 
 
-def get_sample_info(image, font_path, is_vertical=False):
+def get_sample_info(image, font_path, is_vertical=False, render_info=None):
     """获取样本的完整信息
+    render_info: 渲染函数返回的样本信息，给出时直接由文字和背景颜色分类，不再分析图片
     Returns: dict with font_name, direction, color_type, sample_dir
     """
     font_name = get_font_name(font_path)
-    direction = get_text_direction(is_vertical)
-    color_type = analyze_text_color(image)
+    if render_info is not None:
+        direction = render_info['direction']
+        color_type = classify_text_color(render_info['text_color'], render_info['bg_color'])
+    else:
+        direction = get_text_direction(is_vertical)
+        t = tic()
+        color_type = analyze_text_color(image)
+        toc('color_analysis', t)
     
     return {
         'font_name': font_name,
@@ -83,12 +102,30 @@ def get_sample_info(image, font_path, is_vertical=False):
     }
 
 
-def save_organized_sample(image, chars, output_dir, font_path, is_vertical, img_index):
+def encode_image(image, quality=75):
+    """编码为 JPEG 字节串，cv2 编码时会释放 GIL，可以在线程池中并行
+    image: PIL 图片或 RGB 数组
+    """
+    if isinstance(image, Image.Image):
+        image = np.asarray(image.convert('RGB') if image.mode != 'RGB' else image)
+    bgr = cv2.cvtColor(np.asarray(image, dtype=np.uint8), cv2.COLOR_RGB2BGR)
+    ok, buf = cv2.imencode('.jpg', bgr, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise ValueError('JPEG encoding failed')
+    return buf.tobytes()
+
+
+def get_sample_filename(chars, img_index):
+    """样本文件名"""
+    return f"img_{img_index:07d}_{chars}.jpg"
+
+
+def save_organized_sample(image, chars, output_dir, font_path, is_vertical, img_index, render_info=None):
     """保存组织化的样本到对应子文件夹
     Returns: 保存的文件路径
     """
     # 获取样本信息
-    sample_info = get_sample_info(image, font_path, is_vertical)
+    sample_info = get_sample_info(image, font_path, is_vertical, render_info)
     
     # 创建目录
     sample_dir = create_sample_directory(
@@ -99,13 +136,14 @@ def save_organized_sample(image, chars, output_dir, font_path, is_vertical, img_
     )
     
     # 生成文件名
-    filename = f"img_{img_index:07d}_{chars}.jpg"
+    filename = get_sample_filename(chars, img_index)
     filepath = os.path.join(sample_dir, filename)
     
     # 保存图像
     if isinstance(image, Image.Image):
         image.save(filepath)
     else:
-        cv2.imwrite(filepath, image)
+        # 数组为 RGB 顺序，cv2 写文件需要 BGR
+        cv2.imwrite(filepath, cv2.cvtColor(np.asarray(image, dtype=np.uint8), cv2.COLOR_RGB2BGR))
     
     return filepath, sample_info
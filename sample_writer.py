@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Sample writer utilities for OCR image generation
+Contains a bounded thread pool that encodes and saves samples while the next ones are rendered
+"""
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from sample_organizer import get_sample_info, encode_image, get_sample_filename
+from profiler import tic, toc
+
+
+class SampleWriter(object):
+    """
+    在后台线程池中完成样本的颜色分类、JPEG 编码和写盘，渲染线程只负责提交。
+    - 最多 max_pending 个样本在排队，队列满时 submit 等待最早的样本写完（背压）
+    - 标签行按编号顺序提交，且只在对应图片写入磁盘之后，每 flush_every 行批量写入一次
+    - close() 会等待所有已提交的样本，程序中断时在 finally 中调用，保证每条标签都有图片
+    """
+
+    def __init__(self, output_dir, labels, threads=2, max_pending=64, flush_every=100,
+                 shard_writer=None, on_commit=None, on_flush=None):
+        """
+        :param labels: 标签文件对象
+        :param shard_writer: ShardWriter，为 None 时按 font/direction/color 目录结构保存
+        :param on_commit: 回调 on_commit(img_index, chars, sample_info)，在提交标签时按编号顺序调用
+        :param on_flush: 回调 on_flush(last_index)，标签写入文件后调用，last_index 为最后提交的样本编号
+        """
+        self.output_dir = output_dir
+        self.labels = labels
+        self.max_pending = max(1, max_pending)
+        self.flush_every = flush_every
+        self.shard_writer = shard_writer
+        self.on_commit = on_commit
+        self.on_flush = on_flush
+        self.last_index = None
+        self._pool = ThreadPoolExecutor(max(1, threads))
+        self._pending = deque()
+        self._lines = []
+        self._dirs = set()
+
+    def _save(self, image, chars, font_path, is_vertical, img_index, render_info):
+        """线程池任务：分类、编码，目录模式下直接写文件"""
+        sample_info = get_sample_info(image, font_path, is_vertical, render_info)
+        t = tic()
+        data = encode_image(image)
+        t = toc('encode', t)
+        if self.shard_writer is not None:
+            # tar 分片只能顺序写入，留到提交时再写
+            return sample_info, data
+
+        sample_dir = os.path.join(self.output_dir, sample_info['font_name'], sample_info['direction'],
+                                  sample_info['color_type'])
+        if sample_dir not in self._dirs:
+            os.makedirs(sample_dir, exist_ok=True)
+            self._dirs.add(sample_dir)
+        filename = get_sample_filename(chars, img_index)
+        with open(os.path.join(sample_dir, filename), 'wb') as f:
+            f.write(data)
+        toc('save', t)
+        return sample_info, os.path.relpath(os.path.join(sample_dir, filename), self.output_dir)
+
+    def submit(self, image, chars, font_path, is_vertical, img_index, render_info=None):
+        """
+        提交一个样本，提交后不要再修改 image
+        :param render_info: 渲染函数返回的样本信息，有则直接用来分类
+        """
+        t = tic()
+        while len(self._pending) >= self.max_pending:
+            self._commit_one()
+        toc('write_backpressure', t)
+        future = self._pool.submit(self._save, image, chars, font_path, is_vertical, img_index, render_info)
+        self._pending.append((img_index, chars, future))
+        # 顺带提交已经写完的样本
+        while self._pending and self._pending[0][-1].done():
+            self._commit_one()
+
+    def _commit_one(self):
+        """等待最早提交的样本写完，生成它的标签行"""
+        img_index, chars, future = self._pending.popleft()
+        try:
+            sample_info, result = future.result()
+            relative_path = result
+            if self.shard_writer is not None:
+                t = tic()
+                relative_path = self.shard_writer.add_sample(result, chars, sample_info, img_index)
+                toc('save', t)
+        except Exception as e:
+            print(f'Error saving sample {img_index}: {e}')
+            return
+
+        self._lines.append(f"{img_index}\t{relative_path}\t{chars}\t{sample_info['font_name']}\t"
+                           f"{sample_info['direction']}\t{sample_info['color_type']}\n")
+        self.last_index = img_index
+        if self.on_commit is not None:
+            self.on_commit(img_index, chars, sample_info)
+        if len(self._lines) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """把已提交的标签行写入标签文件"""
+        if self._lines:
+            self.labels.writelines(self._lines)
+            self.labels.flush()
+            self._lines = []
+            if self.on_flush is not None:
+                self.on_flush(self.last_index)
+
+    def close(self):
+        """等待所有样本写完并写出全部标签"""
+        while self._pending:
+            self._commit_one()
+        self.flush()
+        self._pool.shutdown()
+        if self.shard_writer is not None:
+            self.shard_writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
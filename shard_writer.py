@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+Sharded output utilities for OCR image generation
+Contains a tar (WebDataset-style) shard writer with per-shard indexes and a random-access reader
+"""
+import io
+import os
+import json
+import tarfile
+
+import cv2
+import numpy as np
+
+from cache_utils import atomic_write
+from sample_organizer import get_sample_info, encode_image
+
+# 每个样本在 tar 中的成员：图片、文字和样本信息，文件名前缀相同（WebDataset 约定）
+IMAGE_EXT = 'jpg'
+TEXT_EXT = 'txt'
+META_EXT = 'json'
+
+
+def shard_name(first_index):
+    """分片以其中第一个样本的编号命名，断点续跑和多进程时不会重名"""
+    return f'shard_{first_index:07d}.tar'
+
+
+def sample_key(img_index):
+    return f'img_{img_index:07d}'
+
+
+class ShardWriter(object):
+    """
+    将样本打包写入固定大小的 tar 分片，代替每个样本一个 JPEG 文件的目录结构。
+    每个样本写入 <key>.jpg、<key>.txt 和 <key>.json 三个成员，
+    分片关闭时写出索引文件 <shard>.idx，每行为 成员名\t数据偏移\t数据长度，读取时可直接定位。
+    """
+
+    def __init__(self, output_dir, shard_size=10000):
+        self.output_dir = output_dir
+        self.shard_size = shard_size
+        self._tar = None
+        self._path = None
+        self._index = []
+        self._count = 0
+
+    def _open(self, first_index):
+        self._path = os.path.join(self.output_dir, shard_name(first_index))
+        self._tar = tarfile.open(self._path, 'w', format=tarfile.USTAR_FORMAT)
+        self._index = []
+        self._count = 0
+
+    def _add(self, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        self._tar.addfile(info, io.BytesIO(data))
+        # addfile 之后 offset 指向补齐到 512 字节的数据块末尾
+        blocks = -(-len(data) // tarfile.BLOCKSIZE)
+        self._index.append((name, self._tar.offset - blocks * tarfile.BLOCKSIZE, len(data)))
+
+    def write(self, image, chars, font_path, is_vertical, img_index, render_info=None):
+        """
+        写入一个样本
+        :param render_info: 渲染函数返回的样本信息，用于分类
+        :return: (样本路径 <shard>.tar/<key>.jpg，相对于 output_dir；样本信息)
+        """
+        sample_info = get_sample_info(image, font_path, is_vertical, render_info)
+        return self.add_sample(encode_image(image), chars, sample_info, img_index), sample_info
+
+    def add_sample(self, data, chars, sample_info, img_index):
+        """
+        写入已编码的样本，编码可以在其他线程中完成，写入需要按顺序在同一个线程中进行
+        :return: 样本路径
+        """
+        if self._tar is None or self._count >= self.shard_size:
+            self.close()
+            self._open(img_index)
+
+        key = sample_key(img_index)
+        meta = dict(sample_info, index=img_index, chars=chars)
+        self._add(f'{key}.{IMAGE_EXT}', data)
+        self._add(f'{key}.{TEXT_EXT}', chars.encode('utf-8'))
+        self._add(f'{key}.{META_EXT}', json.dumps(meta, ensure_ascii=False).encode('utf-8'))
+        # 每个样本写完就刷新，程序中断时已写入的样本仍可读取
+        self._tar.fileobj.flush()
+        self._count += 1
+        return f'{os.path.basename(self._path)}/{key}.{IMAGE_EXT}'
+
+    def close(self):
+        """结束当前分片并写出索引"""
+        if self._tar is None:
+            return
+        self._tar.close()
+        write_index(self._path, self._index)
+        self._tar = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def index_path(tar_path):
+    return os.path.splitext(tar_path)[0] + '.idx'
+
+
+def write_index(tar_path, entries):
+    """先写临时文件再改名"""
+    path = index_path(tar_path)
+    with atomic_write(path, 'w', encoding='utf-8') as f:
+        for name, offset, size in entries:
+            f.write(f'{name}\t{offset}\t{size}\n')
+
+
+def scan_index(tar_path):
+    """没有索引文件时（例如写入中断）扫描 tar 重建索引，末尾不完整的成员被忽略"""
+    entries = []
+    try:
+        with tarfile.open(tar_path, 'r') as tar:
+            for member in tar:
+                if member.offset_data + member.size > os.path.getsize(tar_path):
+                    break
+                entries.append((member.name, member.offset_data, member.size))
+    except (tarfile.ReadError, EOFError) as e:
+        print(f'Shard {tar_path} is truncated: {e}')
+    return entries
+
+
+class ShardReader(object):
+    """
+    按样本随机读取一个分片。
+    reader[i] 或 reader['img_0000001'] 返回 {'jpg': bytes, 'txt': bytes, 'json': bytes}
+    """
+
+    def __init__(self, tar_path):
+        self.tar_path = tar_path
+        entries = None
+        if os.path.exists(index_path(tar_path)):
+            with open(index_path(tar_path), 'r', encoding='utf-8') as f:
+                entries = [(name, int(offset), int(size))
+                           for name, offset, size in (line.rstrip('\n').split('\t') for line in f)]
+        else:
+            entries = scan_index(tar_path)
+
+        self._members = {}
+        self.keys = []
+        for name, offset, size in entries:
+            key, ext = name.rsplit('.', 1)
+            if key not in self._members:
+                self._members[key] = {}
+                self.keys.append(key)
+            self._members[key][ext] = (offset, size)
+        self._file = open(tar_path, 'rb')
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self._members
+
+    def __getitem__(self, item):
+        key = self.keys[item] if isinstance(item, int) else item
+        sample = {}
+        for ext, (offset, size) in self._members[key].items():
+            self._file.seek(offset)
+            sample[ext] = self._file.read(size)
+        return sample
+
+    def read_image(self, key):
+        """返回 RGB 图片数组"""
+        offset, size = self._members[key][IMAGE_EXT]
+        self._file.seek(offset)
+        data = np.frombuffer(self._file.read(size), dtype=np.uint8)
+        return cv2.cvtColor(cv2.imdecode(data, cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+
+    def read_meta(self, key):
+        offset, size = self._members[key][META_EXT]
+        self._file.seek(offset)
+        return json.loads(self._file.read(size).decode('utf-8'))
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def list_shards(output_dir):
+    """输出目录下的所有分片，按第一个样本的编号排序"""
+    return sorted(os.path.join(output_dir, name) for name in os.listdir(output_dir)
+                  if name.startswith('shard_') and name.endswith('.tar'))
+
+
+def read_sample(output_dir, relative_path, readers=None):
+    """
+    按 labels.txt 中的路径 <shard>.tar/<key>.jpg 读取图片
+    :param readers: dict，缓存已打开的 ShardReader
+    """
+    shard, member = relative_path.split('/', 1)
+    readers = {} if readers is None else readers
+    reader = readers.get(shard)
+    if reader is None:
+        reader = readers[shard] = ShardReader(os.path.join(output_dir, shard))
+    return reader.read_image(member.rsplit('.', 1)[0])
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming utilities for OCR image generation
+Contains an in-memory sample stream over the same rendering path as main(), and a PyTorch IterableDataset wrapper
+
+    from streaming import stream_config, SampleStream, OCRIterableDataset
+    cf = stream_config(fonts_path='./fonts', seed=1)
+    for image, chars, meta in SampleStream(cf, end=1001):
+        ...
+    loader = torch.utils.data.DataLoader(OCRIterableDataset(cf), batch_size=None, num_workers=4)
+"""
+import itertools
+
+import cv2
+
+from OCR_image_generator import build_parser, GeneratorContext, render_sample
+from sample_organizer import get_sample_info
+from noiser import NoiseBank
+from rng_utils import DEFAULT_RNG, new_run_seed
+
+try:
+    from torch.utils.data import IterableDataset, get_worker_info
+except ImportError:  # 没有安装 torch 时仍可使用 SampleStream
+    IterableDataset = object
+    get_worker_info = None
+
+
+def stream_config(args=(), **overrides):
+    """
+    与 main() 相同的参数，args 为命令行参数列表，overrides 覆盖其中的值
+    e.g. stream_config(['--blur'], fonts_path='./fonts', seed=1)
+    """
+    cf = build_parser().parse_args(list(args))
+    for key, value in overrides.items():
+        if not hasattr(cf, key):
+            raise ValueError('Unknown option: %s' % key)
+        setattr(cf, key, value)
+    return cf
+
+
+class SampleStream(object):
+    """
+    在内存中逐个渲染样本，返回 (uint8 RGB 数组, 文字, meta)，不经过 JPEG 编码和磁盘。
+    样本 i 由 (cf.seed, i) 决定，与 main() 用同样参数生成的第 i 个样本相同（保存前），
+    也可以用 stream[i] 随机访问任意一个样本。
+    资源（字体、色彩库、背景）在第一次使用时才加载，可以在 fork 出的子进程中使用。
+    """
+
+    def __init__(self, cf, start=1, end=None, step=1, noise_bank=None, transform=None):
+        """
+        :param cf: stream_config() 或 build_parser() 得到的参数，cf.seed 为 None 时取一个随机种子
+        :param start, end, step: 样本编号 range(start, end, step)，end 为 None 时无限生成
+        :param noise_bank: 主进程中创建的 NoiseBank，子进程按名字映射同一块共享内存
+        :param transform: 对图片数组调用的函数，如转换为 tensor
+        """
+        if cf.seed is None:
+            # 在创建时确定种子，之后 fork 出的所有子进程使用同一个种子
+            cf.seed = new_run_seed()
+        self.cf = cf
+        self.start = start
+        self.end = end
+        self.step = step
+        self.noise_bank_spec = noise_bank.spec if noise_bank is not None else None
+        self.transform = transform
+        self._ctx = None
+
+    @property
+    def ctx(self):
+        if self._ctx is None:
+            noise_bank = None
+            if self.noise_bank_spec is not None:
+                noise_bank = NoiseBank.attach(self.noise_bank_spec)
+            self._ctx = GeneratorContext(self.cf, noise_bank)
+        return self._ctx
+
+    def indices(self):
+        if self.end is None:
+            return itertools.count(self.start, self.step)
+        return iter(range(self.start, self.end, self.step))
+
+    def __len__(self):
+        if self.end is None:
+            raise TypeError('Infinite stream has no length')
+        return len(range(self.start, self.end, self.step))
+
+    def __getitem__(self, index):
+        """渲染编号为 index 的样本"""
+        image, chars, font_path, is_vertical, render_info = render_sample(self.ctx, index)
+        sample_info = get_sample_info(image, font_path, is_vertical, render_info)
+        meta = dict(render_info, index=index, font_name=sample_info['font_name'],
+                    color_type=sample_info['color_type'])
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, chars, meta
+
+    def __iter__(self):
+        for i in self.indices():
+            try:
+                yield self[i]
+            except Exception as e:
+                # 与 generate_samples 一致，出错的样本跳过
+                print(f'Error generating sample {i}: {e}')
+                continue
+
+
+class OCRIterableDataset(IterableDataset):
+    """
+    PyTorch IterableDataset：每个 DataLoader 子进程从 start + worker_id 开始，
+    每隔 num_workers 个编号取一个，各子进程的样本互不重复，合起来与单进程时相同。
+    样本的随机数只由 (cf.seed, 编号) 决定，子进程中还会用 DataLoader 给的种子重新播种默认生成器。
+    """
+
+    def __init__(self, cf, start=1, end=None, noise_bank=None, transform=None):
+        if get_worker_info is None:
+            raise ImportError('OCRIterableDataset requires torch')
+        super(OCRIterableDataset, self).__init__()
+        self.stream = SampleStream(cf, start, end, noise_bank=noise_bank, transform=transform)
+        # 每个子进程的样本流，资源只在第一次迭代时加载，persistent_workers 时之后的 epoch 直接复用
+        self._worker_streams = {}
+
+    def __len__(self):
+        return len(self.stream)
+
+    def _worker_stream(self, info):
+        worker = self._worker_streams.get(info.id)
+        if worker is None:
+            stream = self.stream
+            # fork 出的子进程继承了父进程默认生成器的状态，用 DataLoader 分给子进程的种子重新播种
+            DEFAULT_RNG.seed(info.seed)
+            # 每个子进程只用一个 OpenCV 线程，避免与其他子进程争抢 CPU
+            cv2.setNumThreads(1)
+            worker = SampleStream(stream.cf, stream.start + info.id * stream.step, stream.end,
+                                  stream.step * info.num_workers, transform=stream.transform)
+            worker.noise_bank_spec = stream.noise_bank_spec
+            self._worker_streams[info.id] = worker
+        return worker
+
+    def __iter__(self):
+        info = get_worker_info()
+        if info is None:
+            return iter(self.stream)
+        return iter(self._worker_stream(info))
@@ -4,32 +4,104 @@ Text generation utilities for OCR image generation
 Contains functions for generating text content and corpus handling
 """
 import os
-import random
+import mmap
+import numpy as np
+
+from cache_utils import get_cache_dir, file_key, atomic_write
+from rng_utils import get_rng
+
+
+def build_line_index(buf, chunk_size=64 * 1024 * 1024):
+    """
+    扫描换行符，返回行偏移数组 offsets，第 i 行为 buf[offsets[i]:offsets[i + 1]]
+    分块扫描，多 GB 的文件也不会一次性占用大量内存
+    """
+    size = len(buf)
+    starts = [np.zeros(1, dtype=np.int64)]
+    for begin in range(0, size, chunk_size):
+        chunk = np.frombuffer(buf[begin:begin + chunk_size], dtype=np.uint8)
+        starts.append(np.flatnonzero(chunk == ord('\n')).astype(np.int64) + (begin + 1))
+    offsets = np.concatenate(starts)
+    if offsets[-1] != size:
+        offsets = np.append(offsets, size)
+    return offsets
+
+
+class Corpus(object):
+    """
+    内存映射的多文件语料库。
+    每个文件的行偏移索引只建立一次并保存在磁盘缓存中，语料内容不会读入 Python 字符串列表。
+    支持 len() 和下标访问，random.choice(corpus) 可以在 O(1) 时间内取到随机一行。
+    """
+
+    def __init__(self, txt_files):
+        self.txt_files = []
+        self._maps = []
+        self._offsets = []
+        counts = []
+        for path in txt_files:
+            if os.path.getsize(path) == 0:
+                continue
+            with open(path, 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            offsets = self._load_index(path, mm)
+            self.txt_files.append(path)
+            self._maps.append(mm)
+            self._offsets.append(offsets)
+            counts.append(len(offsets) - 1)
+        self._cum_counts = np.cumsum(counts, dtype=np.int64)
+
+    @staticmethod
+    def _load_index(path, mm):
+        """读取保存的行偏移索引，文件变化后重新建立"""
+        index_file = os.path.join(get_cache_dir(), 'corpus_%s.npy' % file_key(path))
+        if os.path.exists(index_file):
+            try:
+                return np.load(index_file, mmap_mode='r')
+            except (OSError, ValueError) as e:
+                print('Could not load corpus index %s: %s' % (index_file, e))
+
+        offsets = build_line_index(mm)
+        try:
+            with atomic_write(index_file) as f:
+                np.save(f, offsets)
+        except OSError as e:
+            print('Could not save corpus index %s: %s' % (index_file, e))
+        return offsets
+
+    def __len__(self):
+        return int(self._cum_counts[-1]) if len(self._cum_counts) else 0
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('corpus line index out of range')
+        k = int(np.searchsorted(self._cum_counts, i, side='right'))
+        line_no = i - (int(self._cum_counts[k - 1]) if k else 0)
+        offsets = self._offsets[k]
+        line = self._maps[k][offsets[line_no]:offsets[line_no + 1]].decode('utf-8', errors='ignore')
+        return line.strip().replace('\xef\xbb\xbf', '').replace('\ufeff', '')
 
 
 def get_char_lines(txt_root_path):
-    """从文本文件中读取字符行"""
-    txt_files = os.listdir(txt_root_path) 
-    char_lines = []
-    for txt in txt_files:
-        f = open(os.path.join(txt_root_path, txt), mode='r', encoding='utf-8')
-        lines = f.readlines()
-        f.close()
-        for line in lines:
-            char_lines.append(line.strip().replace('\xef\xbb\xbf', '').replace('\ufeff', ''))
-        return char_lines
-
-
-def get_chars(char_lines):
+    """读取语料目录下的所有 txt 文件，返回可按行随机访问的语料库"""
+    txt_files = sorted(os.path.join(txt_root_path, txt) for txt in os.listdir(txt_root_path)
+                       if txt.endswith('.txt'))
+    return Corpus(txt_files)
+
+
+def get_chars(char_lines, rng=None):
     """获取随机字符串 - 限制为1-2个字符"""
+    rng = get_rng(rng)
     while True:
-        char_line = random.choice(char_lines)
+        char_line = rng.choice(char_lines)
         if len(char_line) > 0:
             break
     line_len = len(char_line)         
-    char_len = random.randint(1, 2)  # 限制为1-2个字符
+    char_len = rng.randint(1, 2)  # 限制为1-2个字符
     if line_len <= char_len:
         return char_line
-    char_start = random.randint(0, line_len - char_len)
+    char_start = rng.randint(0, line_len - char_len)
     chars = char_line[char_start:(char_start + char_len)]
     return chars
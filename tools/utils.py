@@ -1,7 +1,6 @@
 #!/usr/env/bin python3
 import glob
 import os
-import random
 
 import cv2
 import matplotlib.pyplot as plt
@@ -10,6 +9,8 @@ import numpy as np
 import hashlib
 import sys
 
+from rng_utils import get_rng
+
 
 def viz_img(text_im, fignum=1):
     """
@@ -28,12 +29,13 @@ def viz_img(text_im, fignum=1):
     # plt.show(block=True)
 
 
-def prob(percent):
+def prob(percent, rng=None):
     """
     percent: 0 ~ 1, e.g: 如果 percent=0.1，有 10% 的可能性
+    rng: 样本的随机数生成器（rng_utils.SampleRandom），默认使用 rng_utils.DEFAULT_RNG
     """
     assert 0 <= percent <= 1
-    if random.uniform(0, 1) <= percent:
+    if get_rng(rng).uniform(0, 1) <= percent:
         return True
     return False
 
@@ -113,16 +115,17 @@ def md5(string):
     return m.hexdigest()
 
 
-def apply(cfg_item):
+def apply(cfg_item, rng=None):
     """
     :param cfg_item: a sub cfg item in default.yml, it should contain enable and fraction. such as
                 prydown:
                     enable: true
                     fraction: 0.03
+    :param rng: 样本的随机数生成器（rng_utils.SampleRandom），默认使用 rng_utils.DEFAULT_RNG
     :return: True/False
     """
 
-    if cfg_item.enable and prob(cfg_item.fraction):
+    if cfg_item.enable and prob(cfg_item.fraction, rng):
         return True
 
     return False